@@ -0,0 +1,22 @@
+import numpy as np
+
+# Floating point type of every array allocated by terra's generators and
+# solvers unless a dtype is passed explicitly. Filters keep the dtype of
+# their input. Switching to np.float32 halves memory on large maps.
+DTYPE = np.float64
+
+def set_dtype(dtype):
+    """
+    Set the package-wide floating point type, e.g. set_dtype(np.float32).
+    """
+    global DTYPE
+    dtype = np.dtype(dtype)
+    if dtype.kind != "f":
+        raise ValueError(f"terra needs a floating point dtype, got {dtype}")
+    DTYPE = dtype.type
+
+def get_dtype(dtype=None):
+    """
+    Resolve a dtype argument: None means the package-wide default.
+    """
+    return np.dtype(DTYPE if dtype is None else dtype)
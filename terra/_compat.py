@@ -0,0 +1,15 @@
+"""
+Fallbacks for optional dependencies.
+"""
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    # without numba the decorated kernels run as plain Python
+    HAS_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
@@ -8,16 +8,61 @@ https://github.com/Huw-man/Interactive-Erosion-Simulator-on-GPU
 Other implementation:
 https://github.com/karhu/terrain-erosion/blob/master/Simulation/FluidSimulation.cpp
 """
+import os
+import multiprocessing
+import multiprocessing.connection
+import threading
+import warnings
+from multiprocessing import shared_memory
 import numpy as np
-from numba import njit, prange
 from tqdm import tqdm
-from terra.randd import perlin
+from terra import get_dtype
+from terra.randd import perlin, _resize
+from terra._compat import njit, prange, HAS_NUMBA
+
+# Default step backend: "numba" (compiled kernels) or "numpy". Without numba
+# the solver steps with the vectorized _step_numpy instead, which follows the
+# double buffered parallel kernel and warns, see _resolve_backend.
+BACKEND = "numba" if HAS_NUMBA else "numpy"
+
+#####################################################
+# Simulation constants
+A_PIPE = 0.6  # virtual pipe cross section
+G = 9.81      # gravitational acceleration
+L_PIPE = 1    # virtual pipe length
+LX = 1        # horizontal distance between grid points
+LY = 1        # vertical distance between grid points
+SOIL_CAP = 0.1  # most terrain a node erodes or deposits per step of dt_ref
+#####################################################
 
 @njit
 def _update(z, h, r, s, fL, fR, fT, fB, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0.003, erosion_flag=True):
     """
     Updates the terrain height, water height, suspended sediment amount,
-    and other fields for one time step.
+    and other fields for one time step, allocating fresh scratch buffers.
+    Use ErosionSolver to step repeatedly without allocating.
+
+    Returns z, h, s, fL, fR, fT, fB and the velocity (u, v) and slope (g)
+    fields of the step.
+    """
+    H = np.empty_like(z)
+    h1 = np.empty_like(z)
+    h2 = np.zeros_like(z)
+    u = np.zeros_like(z)
+    v = np.zeros_like(z)
+    s1 = np.zeros_like(z)
+    g = np.zeros_like(z)
+    stats = np.zeros(5)
+    dz = np.zeros_like(z)
+    _step(z, h, r, s, fL, fR, fT, fB, H, h1, h2, u, v, s1, g, dz, stats, dt, k_c, k_s, k_d, SOIL_CAP, k_e, erosion_flag)
+    return z, h, s, fL, fR, fT, fB, u, v, g
+
+@njit
+def _step(z, h, r, s, fL, fR, fT, fB, H, h1, h2, u, v, s1, g, dz, stats, dt, k_c, k_s, k_d, soil_cap, k_e,
+          erosion_flag):
+    """
+    Updates the terrain height, water height, suspended sediment amount,
+    and other fields for one time step in place.
 
     Args:
     - z: 2D numpy array representing the terrain height
@@ -32,27 +77,28 @@ def _update(z, h, r, s, fL, fR, fT, fB, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0
     - k_c: sediment capacity constant
     - k_s: dissolving constant
     - k_d: deposition constant
+    - soil_cap: most terrain height a node erodes or deposits per step
     - k_e: evaporation constant
     - erosion_flag: flag to enable/disable erosion
+    - H, h1, h2, u, v, s1, g: 2D numpy arrays used as scratch buffers,
+      u, v and g hold the velocity and slope fields afterwards
+    - dz: 2D numpy array accumulating the terrain change, it can be reset
+      to measure the change over several steps
+    - stats: numpy array of length 5, set to the largest and the L2 norm of
+      dz, the total suspended sediment, the largest velocity component and
+      the largest water height after the step
     """
-    #####################################################
-    # Simulation constants
-    A_PIPE = 0.6  # virtual pipe cross section
-    G = 9.81      # gravitational acceleration
-    L_PIPE = 1    # virtual pipe length
-    LX = 1        # horizontal distance between grid points
-    LY = 1        # vertical distance between grid points
-    #####################################################
     # get dimensions
     n_x = z.shape[1]
     n_y = z.shape[0]
-    H = z + h  # surface height
-    # auxiliary arrays - should be buffers to speed up things?
-    h2 = np.zeros_like(z)
-    u = np.zeros_like(z)
-    v = np.zeros_like(z)
-    s1 = np.zeros_like(z)
-    g = np.zeros_like(z)
+    # sediment is advected from s1 while it is being filled, cells that
+    # were not visited yet in this step must read as zero
+    s1[:] = 0
+    dz_max = 0.0
+    dz_sq = 0.0
+    sediment = 0.0
+    speed_max = 0.0
+    depth_max = 0.0
     #####################################################
     # the following section titles and equation numbers #
     # were taken from the original paper.               #
@@ -69,7 +115,10 @@ def _update(z, h, r, s, fL, fR, fT, fB, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0
     #####################################################
     # 3.1 Water Increment
     # ========================================================================
-    h1 = h + dt * r  # rainfall increment (eqn 1)
+    for j in range(n_y):
+        for i in range(n_x):
+            H[j, i] = z[j, i] + h[j, i]  # surface height
+            h1[j, i] = h[j, i] + dt * r[j, i]  # rainfall increment (eqn 1)
     # we put this in a separate loop because we need all
     # fluxes calculated before proceeding with calculating
     # water and sediment transportation
@@ -152,6 +201,8 @@ def _update(z, h, r, s, fL, fR, fT, fB, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0
             else:
                 u[j, i] = 0
                 v[j, i] = 0
+            speed_max = max(speed_max, abs(u[j, i]), abs(v[j, i]))
+            depth_max = max(depth_max, h2[j, i])
             if erosion_flag:
                 # 3.3 erosion and deposition
                 # ================================================================
@@ -172,9 +223,10 @@ def _update(z, h, r, s, fL, fR, fT, fB, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0
                 if capacity > s[j, i]:
                     # if capacity exceeds suspended sediment,
                     # erode soil and add it to sediment
-                    delta_soil = min(0.1, k_s * (capacity - s[j, i]))
+                    delta_soil = min(soil_cap, k_s * (capacity - s[j, i]))
                     # eqn 11a
                     z[j, i] -= delta_soil
+                    dz[j, i] -= delta_soil
                     # eqn 11b
                     s1[j, i] = max(0, s[j, i] + delta_soil)
                 else:
@@ -182,11 +234,14 @@ def _update(z, h, r, s, fL, fR, fT, fB, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0
                     # deposit sediment and substract it from sediment.
                     # TODO: this can be probably be simplified so we don't need a conditional!
                     # -> would only work if K_S == K_D
-                    delta_soil = min(0.1, k_d * (s[j, i] - capacity))
+                    delta_soil = min(soil_cap, k_d * (s[j, i] - capacity))
                     # eqn 12a
                     z[j, i] += delta_soil
+                    dz[j, i] += delta_soil
                     # eqn 12b
                     s1[j, i] = max(0, s[j, i] - delta_soil)
+                dz_max = max(dz_max, abs(dz[j, i]))
+                dz_sq += dz[j, i] * dz[j, i]
 
                 # 3.4 sediment transportation
                 # ================================================================
@@ -216,10 +271,11 @@ def _update(z, h, r, s, fL, fR, fT, fB, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0
                 #  j_ub,    |            j_ub,
                 #  i_lb  --------------- i_ub
                 #
-                # calculte corner coordinates
-                j_lb = max(0, min(int(j1), n_x - 1))
+                # calculte corner coordinates, keeping the upper corner
+                # inside the grid (j runs over rows, i over columns)
+                j_lb = max(0, min(int(j1), n_y - 2))
                 j_ub = j_lb + 1
-                i_lb = max(0, min(int(i1), n_y - 1))
+                i_lb = max(0, min(int(i1), n_x - 2))
                 i_ub = i_lb + 1
                 # calculate coordinates for interpolation
                 x = j1 % 1
@@ -234,6 +290,7 @@ def _update(z, h, r, s, fL, fR, fT, fB, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0
                         s1[j_ub, i_ub] * x * y
                     )
                 )
+                sediment += s[j, i]
                 # 3.5 evaporation [OLD]
                 # ================================================================
                 # eqn 15
@@ -253,81 +310,1118 @@ def _update(z, h, r, s, fL, fR, fT, fB, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0
             # 3.6 Heuristic to remove sharp peaks/valleys
             # ================================================================
             # ... TODO: implement
+    stats[0] = dz_max
+    stats[1] = np.sqrt(dz_sq)
+    stats[2] = sediment
+    stats[3] = speed_max
+    stats[4] = depth_max
 
-    return z, h, s, fL, fR, fT, fB, u, v, g
+@njit(parallel=True)
+def _step_parallel(z, h, r, s, fL, fR, fT, fB, H, h1, h2, u, v, s1, g, dz, stats, z1, rows, dt, k_c, k_s, k_d,
+                   soil_cap, k_e, erosion_flag):
+    """
+    Multi-core version of _step. Rows are split across cores in every stage.
+
+    In _step the erosion and advection stages read terrain and sediment
+    values that were already updated earlier in the same sweep, which would
+    race between threads. Here every stage only reads fields completed by an
+    earlier stage: erosion writes the new terrain to z1 and the eroded
+    sediment to s1, advection then reads the complete s1 and copies z1
+    back. The result does not depend on the number of threads, but differs
+    slightly from _step, which reads the partially updated fields.
+
+    Args:
+    same as _step, plus
+    - z1: 2D numpy array used as a buffer for the new terrain height
+    - rows: numpy array of shape (rows, 5) holding the stats of every row,
+      reduced in a fixed order so they do not depend on the thread count
+    """
+    n_x = z.shape[1]
+    n_y = z.shape[0]
+    flux_factor = dt * A_PIPE / L_PIPE * G
+    # 3.1 Water Increment (eqn 1)
+    for j in prange(n_y):
+        for i in range(n_x):
+            H[j, i] = z[j, i] + h[j, i]
+            h1[j, i] = h[j, i] + dt * r[j, i]
+    # 3.2.1 outflow flux computation (eqns 2 - 5)
+    for j in prange(1, n_y - 1):
+        for i in range(1, n_x - 1):
+            fL[j, i] = max(0, fL[j, i] + (H[j, i] - H[j, i - 1]) * flux_factor)
+            fR[j, i] = max(0, fR[j, i] + (H[j, i] - H[j, i + 1]) * flux_factor)
+            fT[j, i] = max(0, fT[j, i] + (H[j, i] - H[j - 1, i]) * flux_factor)
+            fB[j, i] = max(0, fB[j, i] + (H[j, i] - H[j + 1, i]) * flux_factor)
+            sum_f = fL[j, i] + fR[j, i] + fT[j, i] + fB[j, i]
+            if sum_f > 0:
+                adjustment_factor = min(1, h1[j, i] * LX * LY / (sum_f * dt))
+                fL[j, i] *= adjustment_factor
+                fR[j, i] *= adjustment_factor
+                fT[j, i] *= adjustment_factor
+                fB[j, i] *= adjustment_factor
+    # setting edge fluxes to 0 to prevent leaking.
+    fL[0, :] = 0
+    fR[-1, :] = 0
+    fT[:, 0] = 0
+    fB[:, -1] = 0
+    # 3.2.2 water surface and velocity field update (eqns 6 - 9) and
+    # 3.3 erosion and deposition (eqns 10 - 12)
+    for j in prange(n_y):
+        speed_max = 0.0
+        depth_max = 0.0
+        for i in range(n_x):
+            if j == 0 or j == n_y - 1 or i == 0 or i == n_x - 1:
+                z1[j, i] = z[j, i]
+                continue
+            sum_f_in = fR[j, i - 1] + fT[j + 1, i] + fL[j, i + 1] + fB[j - 1, i]
+            sum_f_out = fL[j, i] + fR[j, i] + fT[j, i] + fB[j, i]
+            dh = dt * (sum_f_in - sum_f_out) / (LX * LY)
+            h2[j, i] = h1[j, i] + dh
+            h_mean = h1[j, i] + 0.5 * dh
+            if h_mean > 0:
+                dwx = fR[j, i - 1] - fL[j, i] + fR[j, i] - fL[j, i + 1]
+                dwy = fB[j - 1, i] - fT[j, i] + fB[j, i] - fT[j + 1, i]
+                u[j, i] = dwx / LY / h_mean
+                v[j, i] = dwy / LX / h_mean
+            else:
+                u[j, i] = 0
+                v[j, i] = 0
+            speed_max = max(speed_max, abs(u[j, i]), abs(v[j, i]))
+            depth_max = max(depth_max, h2[j, i])
+            z1[j, i] = z[j, i]
+            if erosion_flag:
+                dzdy = 0.5 * (z[j + 1, i] - z[j - 1, i])
+                dzdx = 0.5 * (z[j, i + 1] - z[j, i - 1])
+                g[j, i] = min(max(dzdx**2 + dzdy**2, -10), 10)
+                sin_local_tilt = np.sqrt(g[j, i] / (g[j, i] + 1))
+                capacity = k_c * max(0.15, sin_local_tilt) * np.sqrt(u[j, i] ** 2 + v[j, i] ** 2)
+                if capacity > s[j, i]:
+                    delta_soil = min(soil_cap, k_s * (capacity - s[j, i]))
+                    z1[j, i] -= delta_soil
+                    s1[j, i] = max(0, s[j, i] + delta_soil)
+                else:
+                    delta_soil = min(soil_cap, k_d * (s[j, i] - capacity))
+                    z1[j, i] += delta_soil
+                    s1[j, i] = max(0, s[j, i] - delta_soil)
+        rows[j, 3] = speed_max
+        rows[j, 4] = depth_max
+    stats[:] = 0
+    for j in range(n_y):
+        stats[3] = max(stats[3], rows[j, 3])
+        stats[4] = max(stats[4], rows[j, 4])
+    if not erosion_flag:
+        return
+    # 3.4 sediment transportation (eqn 14) and 3.5 evaporation (eqn 15)
+    for j in prange(1, n_y - 1):
+        dz_max = 0.0
+        dz_sq = 0.0
+        sediment = 0.0
+        for i in range(1, n_x - 1):
+            dz[j, i] += z1[j, i] - z[j, i]
+            dz_max = max(dz_max, abs(dz[j, i]))
+            dz_sq += dz[j, i] * dz[j, i]
+            z[j, i] = z1[j, i]
+            j1 = j - dt * u[j, i]
+            i1 = i - dt * v[j, i]
+            j_lb = max(0, min(int(j1), n_y - 2))
+            i_lb = max(0, min(int(i1), n_x - 2))
+            x = j1 % 1
+            y = i1 % 1
+            s[j, i] = min(
+                1.0,
+                (
+                    s1[j_lb, i_lb] * (1 - x) * (1 - y) +
+                    s1[j_lb + 1, i_lb] * x * (1 - y) +
+                    s1[j_lb, i_lb + 1] * (1 - x) * y +
+                    s1[j_lb + 1, i_lb + 1] * x * y
+                )
+            )
+            sediment += s[j, i]
+            h[j, i] = h2[j, i] * (1 - k_e * dt)
+        rows[j, 0] = dz_max
+        rows[j, 1] = dz_sq
+        rows[j, 2] = sediment
+    for j in range(1, n_y - 1):
+        stats[0] = max(stats[0], rows[j, 0])
+        stats[1] += rows[j, 1]
+        stats[2] += rows[j, 2]
+    stats[1] = np.sqrt(stats[1])
 
-def erode(heightmap, num_iterations=2, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, 
-          k_e=0.003, erosion_flag=True, R=5, num_droplets=10):
+def _step_numpy(z, h, r, s, fL, fR, fT, fB, H, h1, h2, u, v, s1, g, dz, stats, z1, rows, dt, k_c, k_s, k_d,
+                soil_cap, k_e, erosion_flag):
+    """
+    Vectorized NumPy version of _step_parallel, used when numba is not
+    available. Every stage works on shifted views of whole rows and gives
+    the same result as the compiled kernel up to rounding of the stats.
+    Takes the same arguments as _step_parallel.
+    """
+    n_y = z.shape[0]
+    _rain_rows(z, h, r, H, h1, dt, 0, n_y)
+    _flux_rows(H, h1, fL, fR, fT, fB, dt, 0, n_y)
+    _edge_rows(fL, fR, fT, fB, 0, n_y)
+    _water_rows(z, s, fL, fR, fT, fB, h1, h2, u, v, s1, g, z1, rows, dt, k_c, k_s, k_d, soil_cap, erosion_flag, 0, n_y)
+    if erosion_flag:
+        _advect_rows(z, h, s, h2, u, v, s1, dz, z1, rows, dt, k_e, 0, n_y)
+    _reduce_rows(rows, stats, erosion_flag)
+
+# The stages of _step_numpy work on rows j0 to j1 so they can also be run on
+# strips of a shared map. Every stage only reads fields completed by earlier
+# stages, rows of one stage can be computed independently.
+
+def _interior(j0, j1, n_y):
+    return max(j0, 1), min(j1, n_y - 1)
+
+def _rain_rows(z, h, r, H, h1, dt, j0, j1):
+    # 3.1 Water Increment (eqn 1)
+    np.add(z[j0:j1], h[j0:j1], out=H[j0:j1])
+    np.add(h[j0:j1], dt * r[j0:j1], out=h1[j0:j1])
+
+def _flux_rows(H, h1, fL, fR, fT, fB, dt, j0, j1):
+    # 3.2.1 outflow flux computation (eqns 2 - 5)
+    a, b = _interior(j0, j1, H.shape[0])
+    if a >= b:
+        return
+    flux_factor = dt * A_PIPE / L_PIPE * G
+    Hc = H[a:b, 1:-1]
+    fl, fr, ft, fb = fL[a:b, 1:-1], fR[a:b, 1:-1], fT[a:b, 1:-1], fB[a:b, 1:-1]
+    np.maximum(0, fl + (Hc - H[a:b, :-2]) * flux_factor, out=fl)
+    np.maximum(0, fr + (Hc - H[a:b, 2:]) * flux_factor, out=fr)
+    np.maximum(0, ft + (Hc - H[a - 1:b - 1, 1:-1]) * flux_factor, out=ft)
+    np.maximum(0, fb + (Hc - H[a + 1:b + 1, 1:-1]) * flux_factor, out=fb)
+    sum_f = fl + fr + ft + fb
+    outflow = sum_f > 0
+    adjustment_factor = np.ones_like(sum_f)
+    np.divide(h1[a:b, 1:-1] * LX * LY, sum_f * dt, out=adjustment_factor, where=outflow)
+    np.minimum(1, adjustment_factor, out=adjustment_factor)
+    for f in (fl, fr, ft, fb):
+        np.multiply(f, adjustment_factor, out=f, where=outflow)
+
+def _edge_rows(fL, fR, fT, fB, j0, j1):
+    # setting edge fluxes to 0 to prevent leaking.
+    if j0 == 0:
+        fL[0, :] = 0
+    if j1 == fR.shape[0]:
+        fR[-1, :] = 0
+    fT[j0:j1, 0] = 0
+    fB[j0:j1, -1] = 0
+
+def _water_rows(z, s, fL, fR, fT, fB, h1, h2, u, v, s1, g, z1, rows, dt, k_c, k_s, k_d, soil_cap, erosion_flag,
+                j0, j1):
+    # 3.2.2 water surface and velocity field update (eqns 6 - 9) and
+    # 3.3 erosion and deposition (eqns 10 - 12)
+    z1[j0:j1] = z[j0:j1]
+    if rows is not None:
+        rows[j0:j1, 3:] = 0
+    a, b = _interior(j0, j1, z.shape[0])
+    if a >= b:
+        return
+    fl, fr, ft, fb = fL[a:b, 1:-1], fR[a:b, 1:-1], fT[a:b, 1:-1], fB[a:b, 1:-1]
+    sum_f_in = fR[a:b, :-2] + fT[a + 1:b + 1, 1:-1] + fL[a:b, 2:] + fB[a - 1:b - 1, 1:-1]
+    sum_f_out = fl + fr + ft + fb
+    dh = dt * (sum_f_in - sum_f_out) / (LX * LY)
+    h2[a:b, 1:-1] = h1[a:b, 1:-1] + dh
+    h_mean = h1[a:b, 1:-1] + 0.5 * dh
+    wet = h_mean > 0
+    dwx = fR[a:b, :-2] - fl + fr - fL[a:b, 2:]
+    dwy = fB[a - 1:b - 1, 1:-1] - ft + fb - fT[a + 1:b + 1, 1:-1]
+    uc, vc = u[a:b, 1:-1], v[a:b, 1:-1]
+    uc[:] = 0
+    vc[:] = 0
+    np.divide(dwx / LY, h_mean, out=uc, where=wet)
+    np.divide(dwy / LX, h_mean, out=vc, where=wet)
+    if rows is not None:
+        rows[a:b, 3] = np.maximum(np.abs(uc), np.abs(vc)).max(axis=1)
+        rows[a:b, 4] = h2[a:b, 1:-1].max(axis=1)
+    if not erosion_flag:
+        return
+    dzdy = 0.5 * (z[a + 1:b + 1, 1:-1] - z[a - 1:b - 1, 1:-1])
+    dzdx = 0.5 * (z[a:b, 2:] - z[a:b, :-2])
+    gc = g[a:b, 1:-1]
+    np.minimum(np.maximum(dzdx**2 + dzdy**2, -10), 10, out=gc)
+    sin_local_tilt = np.sqrt(gc / (gc + 1))
+    capacity = k_c * np.maximum(0.15, sin_local_tilt) * np.sqrt(uc ** 2 + vc ** 2)
+    sc = s[a:b, 1:-1]
+    erode = capacity > sc
+    delta_soil = np.where(erode, np.minimum(soil_cap, k_s * (capacity - sc)),
+                          np.minimum(soil_cap, k_d * (sc - capacity)))
+    z1[a:b, 1:-1] = np.where(erode, z[a:b, 1:-1] - delta_soil, z[a:b, 1:-1] + delta_soil)
+    s1[a:b, 1:-1] = np.where(erode, np.maximum(0, sc + delta_soil), np.maximum(0, sc - delta_soil))
+
+def _advect_rows(z, h, s, h2, u, v, s1, dz, z1, rows, dt, k_e, j0, j1):
+    # 3.4 sediment transportation (eqn 14) and 3.5 evaporation (eqn 15)
+    # dz and rows only collect the stats and may be None
+    if rows is not None:
+        rows[j0:j1, :3] = 0
+    n_y, n_x = z.shape
+    a, b = _interior(j0, j1, n_y)
+    if a >= b:
+        return
+    if rows is not None:
+        dzc = dz[a:b, 1:-1]
+        dzc += z1[a:b, 1:-1] - z[a:b, 1:-1]
+        rows[a:b, 0] = np.abs(dzc).max(axis=1)
+        rows[a:b, 1] = (dzc * dzc).sum(axis=1)
+    z[a:b, 1:-1] = z1[a:b, 1:-1]
+    j_src = np.arange(a, b)[:, None] - dt * u[a:b, 1:-1]
+    i_src = np.arange(1, n_x - 1)[None, :] - dt * v[a:b, 1:-1]
+    j_lb = np.clip(j_src.astype(np.int64), 0, n_y - 2)
+    i_lb = np.clip(i_src.astype(np.int64), 0, n_x - 2)
+    x = j_src % 1
+    y = i_src % 1
+    s[a:b, 1:-1] = np.minimum(
+        1.0,
+        (
+            s1[j_lb, i_lb] * (1 - x) * (1 - y) +
+            s1[j_lb + 1, i_lb] * x * (1 - y) +
+            s1[j_lb, i_lb + 1] * (1 - x) * y +
+            s1[j_lb + 1, i_lb + 1] * x * y
+        )
+    )
+    if rows is not None:
+        rows[a:b, 2] = s[a:b, 1:-1].sum(axis=1)
+    h[a:b, 1:-1] = h2[a:b, 1:-1] * (1 - k_e * dt)
+
+def _reduce_rows(rows, stats, erosion_flag):
+    stats[:] = 0
+    stats[3] = rows[:, 3].max()
+    stats[4] = rows[:, 4].max()
+    if erosion_flag:
+        stats[0] = rows[:, 0].max()
+        stats[1] = np.sqrt(rows[:, 1].sum())
+        stats[2] = rows[:, 2].sum()
+
+# Compiled versions of the row stages used by the workers of
+# erode_distributed. They follow the loops of _step_parallel restricted to
+# rows j0 to j1, so their results match the NumPy stages above.
+@njit
+def _rain_strip(z, h, r, H, h1, dt, j0, j1):
+    for j in range(j0, j1):
+        for i in range(z.shape[1]):
+            H[j, i] = z[j, i] + h[j, i]
+            h1[j, i] = h[j, i] + dt * r[j, i]
+
+@njit
+def _flux_strip(H, h1, fL, fR, fT, fB, dt, j0, j1):
+    n_x = H.shape[1]
+    n_y = H.shape[0]
+    flux_factor = dt * A_PIPE / L_PIPE * G
+    for j in range(max(j0, 1), min(j1, n_y - 1)):
+        for i in range(1, n_x - 1):
+            fL[j, i] = max(0, fL[j, i] + (H[j, i] - H[j, i - 1]) * flux_factor)
+            fR[j, i] = max(0, fR[j, i] + (H[j, i] - H[j, i + 1]) * flux_factor)
+            fT[j, i] = max(0, fT[j, i] + (H[j, i] - H[j - 1, i]) * flux_factor)
+            fB[j, i] = max(0, fB[j, i] + (H[j, i] - H[j + 1, i]) * flux_factor)
+            sum_f = fL[j, i] + fR[j, i] + fT[j, i] + fB[j, i]
+            if sum_f > 0:
+                adjustment_factor = min(1, h1[j, i] * LX * LY / (sum_f * dt))
+                fL[j, i] *= adjustment_factor
+                fR[j, i] *= adjustment_factor
+                fT[j, i] *= adjustment_factor
+                fB[j, i] *= adjustment_factor
+    # setting edge fluxes to 0 to prevent leaking.
+    if j0 == 0:
+        fL[0, :] = 0
+    if j1 == n_y:
+        fR[-1, :] = 0
+    for j in range(j0, j1):
+        fT[j, 0] = 0
+        fB[j, -1] = 0
+
+@njit
+def _water_strip(z, s, fL, fR, fT, fB, h1, h2, u, v, s1, g, z1, dt, k_c, k_s, k_d, soil_cap, erosion_flag,
+                 j0, j1):
+    n_x = z.shape[1]
+    n_y = z.shape[0]
+    for j in range(j0, j1):
+        for i in range(n_x):
+            z1[j, i] = z[j, i]
+            if j == 0 or j == n_y - 1 or i == 0 or i == n_x - 1:
+                continue
+            sum_f_in = fR[j, i - 1] + fT[j + 1, i] + fL[j, i + 1] + fB[j - 1, i]
+            sum_f_out = fL[j, i] + fR[j, i] + fT[j, i] + fB[j, i]
+            dh = dt * (sum_f_in - sum_f_out) / (LX * LY)
+            h2[j, i] = h1[j, i] + dh
+            h_mean = h1[j, i] + 0.5 * dh
+            if h_mean > 0:
+                dwx = fR[j, i - 1] - fL[j, i] + fR[j, i] - fL[j, i + 1]
+                dwy = fB[j - 1, i] - fT[j, i] + fB[j, i] - fT[j + 1, i]
+                u[j, i] = dwx / LY / h_mean
+                v[j, i] = dwy / LX / h_mean
+            else:
+                u[j, i] = 0
+                v[j, i] = 0
+            if erosion_flag:
+                dzdy = 0.5 * (z[j + 1, i] - z[j - 1, i])
+                dzdx = 0.5 * (z[j, i + 1] - z[j, i - 1])
+                g[j, i] = min(max(dzdx**2 + dzdy**2, -10), 10)
+                sin_local_tilt = np.sqrt(g[j, i] / (g[j, i] + 1))
+                capacity = k_c * max(0.15, sin_local_tilt) * np.sqrt(u[j, i] ** 2 + v[j, i] ** 2)
+                if capacity > s[j, i]:
+                    delta_soil = min(soil_cap, k_s * (capacity - s[j, i]))
+                    z1[j, i] -= delta_soil
+                    s1[j, i] = max(0, s[j, i] + delta_soil)
+                else:
+                    delta_soil = min(soil_cap, k_d * (s[j, i] - capacity))
+                    z1[j, i] += delta_soil
+                    s1[j, i] = max(0, s[j, i] - delta_soil)
+
+@njit
+def _advect_strip(z, h, s, h2, u, v, s1, z1, dt, k_e, j0, j1):
+    n_x = z.shape[1]
+    n_y = z.shape[0]
+    for j in range(max(j0, 1), min(j1, n_y - 1)):
+        for i in range(1, n_x - 1):
+            z[j, i] = z1[j, i]
+            j_src = j - dt * u[j, i]
+            i_src = i - dt * v[j, i]
+            j_lb = max(0, min(int(j_src), n_y - 2))
+            i_lb = max(0, min(int(i_src), n_x - 2))
+            x = j_src % 1
+            y = i_src % 1
+            s[j, i] = min(
+                1.0,
+                (
+                    s1[j_lb, i_lb] * (1 - x) * (1 - y) +
+                    s1[j_lb + 1, i_lb] * x * (1 - y) +
+                    s1[j_lb, i_lb + 1] * (1 - x) * y +
+                    s1[j_lb + 1, i_lb + 1] * x * y
+                )
+            )
+            h[j, i] = h2[j, i] * (1 - k_e * dt)
+
+def _resolve_backend(backend, parallel):
+    """
+    The backend to step with, warning when the NumPy backend replaces the
+    serial compiled step because numba is missing.
+    """
+    if backend is not None:
+        return backend
+    if BACKEND == "numpy" and not HAS_NUMBA and not parallel:
+        warnings.warn("numba is not installed, erosion falls back to the NumPy backend. It follows the "
+                      "double buffered scheme of parallel=True, so the terrain differs from the default "
+                      "serial step. Pass backend=\"numpy\" or parallel=True to choose it explicitly.",
+                      RuntimeWarning, stacklevel=3)
+    return BACKEND
+
+class ErosionSolver:
+    """
+    Shallow water hydraulic erosion on a heightmap.
+
+    The solver owns all fields and scratch buffers and advances them in
+    place, so stepping does not allocate.
+
+    Attributes:
+    z: numpy array - terrain height
+    h: numpy array - water height
+    s: numpy array - suspended sediment amount
+    fL, fR, fT, fB: numpy arrays - flux towards the left, right, top and bottom neighbor
+    u, v: numpy arrays - velocity field of the last step
+    g: numpy array - squared slope of the last step
+    stats: numpy array - largest and L2 norm of the terrain change since the
+    start of the convergence window, total suspended sediment, largest
+    velocity component and largest water height
+    dt_ref: float - time step k_s, k_d and SOIL_CAP refer to, the first dt.
+    Steps of another length (adaptive or the last one of a duration) erode
+    and deposit in proportion.
+    time: float - simulated time so far
+    adaptive: bool - pick every time step from the CFL condition
+    cfl: float - Courant number of adaptive time steps
+    dt_min, dt_max: float - bounds of adaptive time steps
+    converged: bool - whether iterate stopped early
+    parallel: bool - step with the multi-core, double buffered kernel
+    backend: str - "numba" or "numpy", defaults to the module-level BACKEND.
+    The NumPy backend follows the double buffered kernel.
+    """
+    def __init__(self, z, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0.003, erosion_flag=True, parallel=False,
+                 adaptive=False, cfl=0.5, dt_min=0.01, dt_max=0.5, backend=None):
+        backend = _resolve_backend(backend, parallel)
+        if backend not in ("numpy", "numba"):
+            raise ValueError(f"Unknown erosion backend: {backend}")
+        self.z = z
+        self.dt = dt
+        self.dt_ref = dt
+        self.k_c = k_c
+        self.k_s = k_s
+        self.k_d = k_d
+        self.k_e = k_e
+        self.erosion_flag = erosion_flag
+        self.parallel = parallel
+        self.backend = backend
+        self.adaptive = adaptive
+        self.cfl = cfl
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.iteration = 0
+        self.time = 0.0
+        self.converged = False
+        self.stats = np.zeros(5)
+        self.h = np.zeros_like(z)
+        self.s = np.zeros_like(z)
+        self.fL = np.zeros_like(z)
+        self.fR = np.zeros_like(z)
+        self.fT = np.zeros_like(z)
+        self.fB = np.zeros_like(z)
+        self.u = np.zeros_like(z)
+        self.v = np.zeros_like(z)
+        self.g = np.zeros_like(z)
+        self._H = np.zeros_like(z)
+        self._h1 = np.zeros_like(z)
+        self._h2 = np.zeros_like(z)
+        self._s1 = np.zeros_like(z)
+        double_buffered = parallel or backend == "numpy"
+        self._z1 = np.zeros_like(z) if double_buffered else None
+        self._rows = np.zeros((z.shape[0], 5)) if double_buffered else None
+        self._dz = np.zeros_like(z)
+        self._sediment = 0.0
+
+    def step(self, r, dt=None):
+        """
+        Advance all fields by one time step. In adaptive mode the next time
+        step is then chosen from the velocity and water height of this one.
+
+        Args:
+        r: numpy array - rainfall of this step
+        dt: float - length of this step, defaults to self.dt
+        """
+        dt = self.dt if dt is None else dt
+        scale = dt / self.dt_ref
+        k_s, k_d, soil_cap = scale * self.k_s, scale * self.k_d, scale * SOIL_CAP
+        if self.backend == "numpy":
+            _step_numpy(self.z, self.h, r, self.s, self.fL, self.fR, self.fT, self.fB,
+                        self._H, self._h1, self._h2, self.u, self.v, self._s1, self.g,
+                        self._dz, self.stats, self._z1, self._rows,
+                        dt, self.k_c, k_s, k_d, soil_cap, self.k_e, self.erosion_flag)
+        elif self.parallel:
+            _step_parallel(self.z, self.h, r, self.s, self.fL, self.fR, self.fT, self.fB,
+                           self._H, self._h1, self._h2, self.u, self.v, self._s1, self.g,
+                           self._dz, self.stats, self._z1, self._rows,
+                           dt, self.k_c, k_s, k_d, soil_cap, self.k_e, self.erosion_flag)
+        else:
+            _step(self.z, self.h, r, self.s, self.fL, self.fR, self.fT, self.fB,
+                  self._H, self._h1, self._h2, self.u, self.v, self._s1, self.g, self._dz, self.stats,
+                  dt, self.k_c, k_s, k_d, soil_cap, self.k_e, self.erosion_flag)
+        self.iteration += 1
+        self.time += dt
+        if self.adaptive:
+            self.dt = self.cfl_dt()
+
+    def cfl_dt(self):
+        """
+        Largest stable time step for the state of the last step: a gravity
+        wave on the deepest water may not travel further than cfl grid
+        cells, clamped to [dt_min, dt_max].
+
+        The pipe velocities (stats[3]) are not used, the outflow limit of
+        eqn 4 caps them at about one grid cell per step whatever the time
+        step, so they cannot bound it.
+        """
+        speed = max(np.sqrt(G * A_PIPE / L_PIPE * self.stats[4]), 1e-12)
+        return min(max(self.cfl * min(LX, LY) / speed, self.dt_min), self.dt_max)
+
+    def iterate(self, rain, num_iterations=None, every=1, tol=None, window=10, duration=None):
+        """
+        Step num_iterations times, or until `duration` time has been
+        simulated, and yield the state every `every` steps. The last step of
+        a duration is shortened to end exactly on it.
+
+        With a tolerance the run stops early once the terrain has settled:
+        when over a window of `window` steps the root mean square change of
+        the terrain height is below tol and the total suspended sediment
+        changed by less than tol relative to the start of the window. Single
+        nodes keep moving back and forth as water erodes and deposits, the
+        largest change (stats[0]) does not settle. The last state is always
+        yielded when stopping early. Windows end on multiples of `window`
+        iterations, so a resumed run measures the same windows.
+
+        The yielded arrays are read-only views of the solver's own buffers,
+        they change as the solver keeps stepping and must be copied to be
+        kept.
+
+        Args:
+        rain: list of numpy arrays - rainfall patterns, cycled by iteration,
+              or a callable returning the rainfall of an iteration (see terra.rain)
+        num_iterations: int - number of steps, or the most steps with a duration
+        every: int - yield after every this many steps
+        tol: float - convergence tolerance, None to always run all steps
+        window: int - number of steps the convergence is measured over
+        duration: float - simulated time to run for
+
+        Yields:
+        (iteration, z, h, s): the number of steps taken so far and views of
+        the terrain height, water height and suspended sediment
+        """
+        self.converged = False
+        if duration is not None:
+            end = self.time + duration
+            progress = tqdm(total=duration)
+        else:
+            progress = tqdm(total=num_iterations)
+        n = 0
+        while num_iterations is None or n < num_iterations:
+            n += 1
+            if duration is not None:
+                # the summed time steps may fall short of end by rounding
+                if end - self.time <= 1e-9 * self.dt:
+                    break
+                dt = min(self.dt, end - self.time)
+                progress.update(dt)
+            else:
+                dt = self.dt
+                progress.update(1)
+            self.step(_rain_at(rain, self.iteration), dt)
+            if self.iteration % window == 0:
+                if tol is not None:
+                    rms = self.stats[1] / np.sqrt(self.z.size)
+                    sediment_change = abs(self.stats[2] - self._sediment)
+                    self.converged = bool(rms < tol and sediment_change <= tol * self._sediment)
+                self._dz[:] = 0
+                self._sediment = self.stats[2]
+            if self.iteration % every == 0 or self.converged:
+                yield self.iteration, _read_only(self.z), _read_only(self.h), _read_only(self.s)
+            if self.converged:
+                break
+        progress.close()
+
+def _rain_at(rain, iteration):
+    if callable(rain):
+        return rain(iteration)
+    return rain[iteration % len(rain)]
+
+def _read_only(field):
+    view = field.view()
+    view.flags.writeable = False
+    return view
+
+def _setup(heightmap, dtype):
+    """
+    Normalize the heightmap and precompute the rotated rainfall patterns.
+    """
+    z = heightmap.astype(get_dtype(dtype))
+    z = (z - z.min()) / (z.max() - z.min())
+    return z, _rain_patterns(z)
+
+def _rain_patterns(z):
+    y, x = z.shape
+    # Add a erosion source over the mountains
+    #r = 0.04*z.copy() + 0.01*perlin(x, y, scale=0.5*max(x, y), seed=0)
+    # When eroding the entire terrain, randomly change the rainfall pattern.
+    # This helps a lot against hole formation.
+
+    # Precompute rainfall patterns
+    r_base = 0.04 * z + 0.01 * perlin(x, y, scale=0.5*max(x, y), seed=0, dtype=z.dtype)
+    return cycle_patterns(r_base)
+
+def cycle_patterns(base):
+    """
+    The four rainfall patterns erode cycles through: the rotations of the
+    base pattern on square maps and its mirror images on other maps.
+    """
+    return [np.ascontiguousarray(pattern) for pattern in _pattern_views(base)]
+
+def _pattern_views(base):
+    if base.shape[0] == base.shape[1]:
+        return [np.rot90(base, k) for k in range(4)]
+    return [base, base[:, ::-1], base[::-1, ::-1], base[::-1, :]]
+
+def erode_iter(heightmap, num_iterations=None, every=1, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1,
+               k_e=0.003, erosion_flag=True, dtype=None, parallel=False, tol=None, window=10,
+               duration=None, adaptive=False, cfl=0.5, dt_min=0.01, dt_max=0.5, backend=None):
+    """
+    Hydraulically erode a heightmap, streaming the state while it runs.
+    Takes the same arguments as erode, see ErosionSolver.iterate for what is
+    yielded every `every` steps.
+    """
+    if num_iterations is None and duration is None:
+        num_iterations = 2
+    z, r_patterns = _setup(heightmap, dtype)
+    solver = ErosionSolver(z, dt, k_c=k_c, k_s=k_s, k_d=k_d, k_e=k_e, erosion_flag=erosion_flag,
+                           parallel=parallel, adaptive=adaptive, cfl=cfl, dt_min=dt_min, dt_max=dt_max,
+                           backend=backend)
+    yield from solver.iterate(r_patterns, num_iterations, every, tol, window, duration)
+
+def erode(heightmap, num_iterations=None, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, 
+          k_e=0.003, erosion_flag=True, R=5, num_droplets=10, dtype=None, parallel=False, rain=None,
+          snapshots=1, snapshot_file=None, callback=None, callback_every=1, tol=None, window=10,
+          duration=None, adaptive=False, cfl=0.5, dt_min=0.01, dt_max=0.5, backend=None,
+          checkpoint=None, checkpoint_every=100, resume=False):
     """
     Hydraulically erode a heightmap.
     
     Args:
     - heightmap: 2D numpy array representing the terrain height
-    - num_iterations: number of erosion iterations to perform
-    - dt: time step for each iteration
+    - num_iterations: number of erosion iterations to perform, or the most
+      iterations when a duration is given. Defaults to 2 without a duration
+      and to as many as the duration takes with one.
+    - dt: time step for each iteration, the first one in adaptive mode
     - k_c: sediment capacity constant
     - k_s: dissolving constant
     - k_d: deposition constant
     - k_e: evaporation constant
     - erosion_flag: flag to enable/disable erosion
+    - R, num_droplets: unused, see terra.rain.DropletBursts for rain bursts
+    - dtype: floating point type of all fields, defaults to terra.DTYPE
+    - parallel: use the multi-core, double buffered time step
+    - rain: callable returning the rainfall of an iteration (see
+      terra.rain), defaults to patterns following the heightmap
+    - snapshots: which states to keep, see snapshot_steps
+    - snapshot_file: path prefix, if given the snapshots are written to
+      disk-backed arrays <prefix>_z.npy, <prefix>_h.npy and <prefix>_r.npy
+    - callback: called as callback(iteration, z, h, s) every callback_every
+      steps with read-only views of the current state
+    - callback_every: number of steps between callbacks
+    - tol: stop early once the terrain has settled to this tolerance, see
+      ErosionSolver.iterate. Snapshots after the last step hold the final state.
+    - window: number of steps the convergence is measured over
+    - duration: simulated time to run for instead of a number of iterations
+    - adaptive: choose every time step from the CFL condition, see
+      ErosionSolver.cfl_dt
+    - cfl: Courant number of adaptive time steps
+    - dt_min, dt_max: bounds of adaptive time steps
+    - backend: "numba" or "numpy", defaults to the module-level BACKEND
+    - checkpoint: path of a checkpoint file the full state is written to
+      every checkpoint_every iterations and at the end, see save_checkpoint
+    - checkpoint_every: number of iterations between checkpoints
+    - resume: continue from the checkpoint file if it exists. The run then
+      continues bit-identically up to num_iterations (or duration) in total,
+      heightmap and the solver parameters are taken from the checkpoint and
+      only snapshots from the resumed iteration on are kept. Use the same
+      parallel, backend and rain settings as the original run.
     
     Returns:
-    - eroded_heightmap: 2D numpy array of the eroded terrain
+    - saved_z: 3D numpy array of the terrain height at every snapshot
+    - saved_h: 3D numpy array of the water height at every snapshot
+    - s: 2D numpy array of the final suspended sediment amount
+    - saved_r: 3D numpy array of the rainfall at every snapshot
     """
-    # import and normalize the heightmap
-    z = heightmap.copy()
-    z = (z - z.min()) / (z.max() - z.min())
-    x, y = z.shape
-
-    h = np.zeros_like(z)  # water height
-    s = np.zeros_like(z)  # suspended sediment amount
-    fL = np.zeros_like(z)  # flux towards left neighbor
-    fR = np.zeros_like(z)  # flux towards right neighbor
-    fT = np.zeros_like(z)  # flux towards top neighbor
-    fB = np.zeros_like(z)  # flux towards bottom neighbor
+    if resume and checkpoint is not None and os.path.exists(checkpoint):
+        solver, r_patterns = load_checkpoint(checkpoint, parallel=parallel, backend=backend)
+        z = solver.z
+        rain = r_patterns if rain is None else rain
+    else:
+        # import and normalize the heightmap
+        z, r_patterns = _setup(heightmap, dtype)
+        solver = ErosionSolver(z, dt, k_c=k_c, k_s=k_s, k_d=k_d, k_e=k_e, erosion_flag=erosion_flag,
+                               parallel=parallel, adaptive=adaptive, cfl=cfl, dt_min=dt_min, dt_max=dt_max,
+                               backend=backend)
+        rain = r_patterns if rain is None else rain
+    start = solver.iteration
+    if num_iterations is None and duration is None:
+        num_iterations = 2
+    # every-N snapshots of an open-ended run are added as the run reaches
+    # them, the buffers grow by doubling
+    interval = None
+    if num_iterations is None and _is_interval(snapshots):
+        interval = snapshots
+        steps = snapshot_steps(snapshots, start + 8 * interval)
+    else:
+        steps = snapshot_steps(snapshots, num_iterations)
+    steps = steps[steps >= start]
+    saved_z = _snapshot_buffer(snapshot_file, "z", steps, z)
+    saved_h = _snapshot_buffer(snapshot_file, "h", steps, z)
+    saved_r = _snapshot_buffer(snapshot_file, "r", steps, z)
+    frame = 0
+    if len(steps) and steps[0] == start:
+        saved_z[0], saved_h[0], saved_r[0] = z, solver.h, _rain_at(rain, start)
+        frame += 1
+    if duration is not None:
+        duration -= solver.time
+    remaining = None if num_iterations is None else num_iterations - start
+    for i, z_i, h_i, s_i in solver.iterate(rain, remaining, tol=tol, window=window, duration=duration):
+        if interval is not None and frame == len(steps) and i % interval == 0:
+            steps = np.append(steps, i)
+            if frame == len(saved_z):
+                saved_z, saved_h, saved_r = (_resize_snapshots(snapshot_file, name, saved, 2 * frame)
+                                             for name, saved in zip("zhr", (saved_z, saved_h, saved_r)))
+        if frame < len(steps) and steps[frame] == i:
+            saved_z[frame], saved_h[frame], saved_r[frame] = z_i, h_i, _rain_at(rain, i)
+            frame += 1
+        if callback is not None and i % callback_every == 0:
+            callback(i, z_i, h_i, s_i)
+        if i % 100 == 1:
+            print(f"Iteration {i - 1}: Max height change: {solver.stats[0]}, sediment: {solver.stats[2]}")
+        if checkpoint is not None and i % checkpoint_every == 0:
+            save_checkpoint(checkpoint, solver, r_patterns[0])
+    if checkpoint is not None:
+        save_checkpoint(checkpoint, solver, r_patterns[0])
+    if solver.converged:
+        print(f"Converged after {solver.iteration} iterations")
+    if interval is not None:
+        # like with a number of iterations, only the steps before the last
+        steps = steps[steps < solver.iteration]
+        frame = min(frame, len(steps))
+    # steps after an early stop keep the settled state
+    while frame < len(steps):
+        saved_z[frame], saved_h[frame], saved_r[frame] = z, solver.h, _rain_at(rain, solver.iteration)
+        frame += 1
+    if len(steps) < len(saved_z):
+        saved_z, saved_h, saved_r = (_resize_snapshots(snapshot_file, name, saved, len(steps))
+                                     for name, saved in zip("zhr", (saved_z, saved_h, saved_r)))
+    if snapshot_file is not None:
+        for saved in (saved_z, saved_h, saved_r):
+            saved.flush()
+
+    # Normalize and convert back to image
+    #eroded_heightmap = (eroded_heightmap - eroded_heightmap.min()) / (eroded_heightmap.max() - eroded_heightmap.min())
+    #eroded_img = Image.fromarray((eroded_heightmap * 255).astype(np.uint8))
     
-    saved_z = []
-    saved_h = []
-    saved_r = []
+    return saved_z, saved_h, solver.s, saved_r
 
+# Fields and settings of an ErosionSolver stored in a checkpoint. The scratch
+# buffers and the velocity and slope fields are recomputed by every step, the
+# terrain change and sediment since the start of the convergence window are
+# kept for early stopping.
+CHECKPOINT_FIELDS = ("z", "h", "s", "fL", "fR", "fT", "fB", "_dz")
+CHECKPOINT_SETTINGS = ("dt", "dt_ref", "k_c", "k_s", "k_d", "k_e", "erosion_flag", "adaptive", "cfl", "dt_min",
+                       "dt_max", "iteration", "time", "_sediment")
 
-    # Add a erosion source over the mountains
-    #r = 0.04*z.copy() + 0.01*perlin(x, y, scale=0.5*max(x, y), seed=0)
-    # When eroding the entire terrain, randomly change the rainfall pattern.
-    # This helps a lot against hole formation.
+def save_checkpoint(path, solver, r_base):
+    """
+    Write the full state of an erosion run to an uncompressed .npz file.
+    The file is replaced atomically, a run killed while writing leaves the
+    previous checkpoint intact.
 
-    # Precompute rainfall patterns
-    r_base = 0.04 * z + 0.01 * perlin(x, y, scale=0.5*max(x, y), seed=0)
-    r_patterns = [rotate_array(r_base, k) for k in range(4)]
+    Args:
+    - path: path of the checkpoint file
+    - solver: ErosionSolver to save
+    - r_base: 2D numpy array - unrotated rainfall pattern of the run
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, r_base=r_base,
+                 **{name: getattr(solver, name) for name in CHECKPOINT_FIELDS},
+                 **{name: getattr(solver, name) for name in CHECKPOINT_SETTINGS})
+    os.replace(tmp, path)
 
-    # Precompute droplets
-    droplet_positions, droplet_mask = precompute_droplets((x, y), num_droplets, R)
+def load_checkpoint(path, parallel=False, backend=None):
+    """
+    Restore an erosion run written by save_checkpoint.
 
-    for i in tqdm(range(num_iterations)):
+    Args:
+    - path: path of the checkpoint file
+    - parallel, backend: see ErosionSolver, should match the saved run for
+      the results to continue bit-identically
 
-        # Rotate rainfall pattern
-        r = r_patterns[i % 4]
+    Returns:
+    - solver: ErosionSolver continuing the saved run
+    - r_patterns: list of the four rainfall patterns of the run
+    """
+    with np.load(path) as checkpoint:
+        settings = {name: checkpoint[name].item() for name in CHECKPOINT_SETTINGS}
+        solver = ErosionSolver(checkpoint["z"].copy(), parallel=parallel, backend=backend)
+        for name in CHECKPOINT_FIELDS[1:]:
+            getattr(solver, name)[:] = checkpoint[name]
+        r_base = checkpoint["r_base"].copy()
+    for name, value in settings.items():
+        setattr(solver, name, value)
+    return solver, cycle_patterns(r_base)
 
-        # Add random water droplets
-        #h = add_water_droplets(h, droplet_positions, droplet_mask)
+def erode_multigrid(heightmap, levels=3, num_iterations=100, decay=0.5, dt=0.1, k_c=0.1, k_s=0.1,
+                    k_d=0.1, k_e=0.003, erosion_flag=True, dtype=None, parallel=False, backend=None):
+    """
+    Hydraulically erode a heightmap coarse to fine.
 
-        saved_h.append(h.copy())
-        saved_r.append(r.copy())
-        saved_z.append(z.copy())
-        z, h, s, fL, fR, fT, fB, _, _, _ = _update(z, h, r, s, fL, fR, fT, fB, dt, 
-                                                   k_c=k_c, k_s=k_s, k_d=k_d, k_e=k_e, erosion_flag=erosion_flag)
-        if i % 100 == 0:
-            print(f"Iteration {i}: Max height change: {np.max(np.abs(z - heightmap))}")
+    The heightmap is first eroded at 1 / 2**(levels - 1) of its resolution,
+    where carving the large-scale drainage takes a fraction of the work.
+    The eroded terrain, water and sediment are then upsampled to the next
+    finer level, the detail of the original heightmap that the coarse level
+    could not hold is added back, and the erosion continues with `decay`
+    times as many iterations, down to the full resolution.
 
-    # Normalize and convert back to image
-    #eroded_heightmap = (eroded_heightmap - eroded_heightmap.min()) / (eroded_heightmap.max() - eroded_heightmap.min())
-    #eroded_img = Image.fromarray((eroded_heightmap * 255).astype(np.uint8))
-    
-    return saved_z, saved_h, s, saved_r
+    Args:
+    - heightmap: 2D numpy array representing the terrain height
+    - levels: number of pyramid levels, 1 is a plain full resolution run
+    - num_iterations: number of erosion iterations on the coarsest level
+    - decay: factor applied to the number of iterations at every finer level
+    - dt, k_c, k_s, k_d, k_e, erosion_flag, dtype, parallel, backend: see erode
+
+    Returns:
+    - z: 2D numpy array of the eroded terrain
+    - h: 2D numpy array of the water height
+    - s: 2D numpy array of the suspended sediment amount
+    """
+    z_full, _ = _setup(heightmap, dtype)
+    shapes = [tuple(max(3, n >> level) for n in z_full.shape) for level in range(levels)][::-1]
+    pyramid = [_resize(z_full, shape, order=1) for shape in shapes]
+    z, h, s = pyramid[0].copy(), None, None
+    for level, shape in enumerate(shapes):
+        if level > 0:
+            # coarse erosion plus the detail the coarse level could not hold
+            z = _resize(z, shape, order=1) + (pyramid[level] - _resize(pyramid[level - 1], shape, order=1))
+            h = np.maximum(_resize(h, shape, order=1), 0)
+            s = np.clip(_resize(s, shape, order=1), 0, 1)
+        solver = ErosionSolver(z, dt, k_c=k_c, k_s=k_s, k_d=k_d, k_e=k_e, erosion_flag=erosion_flag,
+                               parallel=parallel, backend=backend)
+        if h is not None:
+            solver.h[:] = h
+            solver.s[:] = s
+        iterations = max(1, int(round(num_iterations * decay ** level)))
+        for _ in solver.iterate(_rain_patterns(pyramid[level]), iterations, every=iterations):
+            pass
+        z, h, s = solver.z, solver.h, solver.s
+    return z, h, s
+
+def erode_ensemble(heightmaps, num_iterations=100, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1, k_e=0.003,
+                   erosion_flag=True, dtype=None, backend=None):
+    """
+    Hydraulically erode an ensemble of heightmaps and/or parameter sets at
+    once, e.g. for parameter sweeps. All members are stacked in 3D arrays
+    and run in a single compiled call, every core working through whole
+    members. Every member gives the same result as erode with its own
+    heightmap and parameters. With the NumPy backend the members are
+    stepped one after another and match erode with backend="numpy".
+
+    Args:
+    - heightmaps: 2D numpy array shared by all members, or 3D numpy array
+      with one heightmap per member
+    - num_iterations: int or 1D array - number of iterations of every member
+    - dt, k_c, k_s, k_d, k_e: float or 1D array - parameters of every
+      member, see erode
+    - erosion_flag: flag to enable/disable erosion
+    - dtype: floating point type of all fields, defaults to terra.DTYPE
+    - backend: "numba" or "numpy", defaults to the module-level BACKEND
+
+    Returns:
+    - z: 3D numpy array of the eroded terrain of every member
+    - h: 3D numpy array of the water height of every member
+    - s: 3D numpy array of the suspended sediment amount of every member
+    """
+    params = np.broadcast_arrays(num_iterations, dt, k_c, k_s, k_d, k_e)
+    members = max(params[0].size, 1 if np.ndim(heightmaps) == 2 else len(heightmaps))
+    params = [np.broadcast_to(p, members).astype(np.float64) for p in params]
+    if np.ndim(heightmaps) == 2:
+        heightmaps = [heightmaps] * members
+    if len(heightmaps) != members:
+        raise ValueError(f"Got {len(heightmaps)} heightmaps for {members} parameter sets")
+    setups = [_setup(heightmap, dtype) for heightmap in heightmaps]
+    z = np.stack([z_m for z_m, _ in setups])
+    r = np.stack([np.stack(r_patterns) for _, r_patterns in setups])
+    backend = _resolve_backend(backend, False)
+    if backend == "numpy":
+        h, s = np.zeros_like(z), np.zeros_like(z)
+        for m in range(members):
+            solver = ErosionSolver(z[m], params[1][m], k_c=params[2][m], k_s=params[3][m], k_d=params[4][m],
+                                   k_e=params[5][m], erosion_flag=erosion_flag, backend=backend)
+            for i in range(int(params[0][m])):
+                solver.step(r[m, i % 4])
+            h[m], s[m] = solver.h, solver.s
+        return z, h, s
+    if backend != "numba":
+        raise ValueError(f"Unknown erosion backend: {backend}")
+    fields = [np.zeros_like(z) for _ in range(14)]
+    stats = np.zeros((members, 5))
+    _erode_ensemble(z, r, *fields, stats, params[0].astype(np.int64), *params[1:], erosion_flag)
+    return z, fields[0], fields[1]
 
 @njit(parallel=True)
+def _erode_ensemble(z, r, h, s, fL, fR, fT, fB, H, h1, h2, u, v, s1, g, dz, stats, iterations,
+                    dt, k_c, k_s, k_d, k_e, erosion_flag):
+    """
+    Run every member of an ensemble, members split across cores. All fields
+    are 3D arrays indexed by member first, r holds the four rainfall
+    patterns of every member and the parameters are 1D arrays.
+    """
+    for m in prange(z.shape[0]):
+        for i in range(iterations[m]):
+            _step(z[m], h[m], r[m, i % 4], s[m], fL[m], fR[m], fT[m], fB[m], H[m], h1[m], h2[m],
+                  u[m], v[m], s1[m], g[m], dz[m], stats[m], dt[m], k_c[m], k_s[m], k_d[m], SOIL_CAP, k_e[m],
+                  erosion_flag)
+
+# Fields of a distributed run, all held in shared memory. The stats are not
+# collected, so there is no terrain change buffer.
+DISTRIBUTED_FIELDS = ("z", "h", "s", "fL", "fR", "fT", "fB", "H", "h1", "h2", "u", "v", "s1", "g", "z1")
+
+def erode_distributed(heightmap, num_iterations=100, workers=None, dt=0.1, k_c=0.1, k_s=0.1, k_d=0.1,
+                      k_e=0.003, erosion_flag=True, dtype=None):
+    """
+    Hydraulically erode a heightmap too large for a single core, split into
+    row strips stepped by separate processes.
+
+    All fields live in shared memory and every worker runs the stages of
+    the NumPy backend on its own strip, compiled when numba is installed. Workers wait for each other between
+    stages, so the halo rows (and the sediment any advection reads) of the
+    neighboring strips are complete before they are read. The result is
+    the same as with backend="numpy" whatever the number of workers. If a
+    worker fails the others are stopped and a RuntimeError is raised.
+
+    Workers are forked. With numba's TBB threading layer, forking after a
+    parallel=True run in the same process can hang the interpreter at
+    exit; set NUMBA_THREADING_LAYER=omp or workqueue to mix the two.
+
+    Args:
+    - heightmap: 2D numpy array representing the terrain height
+    - num_iterations: number of erosion iterations to perform
+    - workers: number of processes, defaults to the number of cores
+    - dt, k_c, k_s, k_d, k_e, erosion_flag, dtype: see erode
+
+    Returns:
+    - z: 2D numpy array of the eroded terrain
+    - h: 2D numpy array of the water height
+    - s: 2D numpy array of the suspended sediment amount
+    """
+    z, r_patterns = _setup(heightmap, dtype)
+    workers = min(workers or os.cpu_count(), z.shape[0])
+    blocks = []
+    try:
+        fields = {name: _shared_array(blocks, z.shape, z.dtype) for name in DISTRIBUTED_FIELDS}
+        fields["z"][:] = z
+        # workers cycle through views of the unrotated rainfall pattern
+        fields["rain"] = _shared_array(blocks, z.shape, z.dtype)
+        fields["rain"][:] = r_patterns[0]
+        layout = {name: (block.name, field.shape, field.dtype.str) for (name, field), block in zip(fields.items(), blocks)}
+        bounds = np.linspace(0, z.shape[0], workers + 1).astype(int)
+        context = multiprocessing.get_context()
+        barrier = context.Barrier(workers)
+        processes = [context.Process(target=_strip_worker,
+                                     args=(layout, bounds[w], bounds[w + 1], barrier, num_iterations,
+                                           dt, k_c, k_s, k_d, k_e, erosion_flag))
+                     for w in range(workers)]
+        for process in processes:
+            process.start()
+        running = {process.sentinel: process for process in processes}
+        while running:
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                process = running.pop(sentinel)
+                process.join()
+                if process.exitcode != 0:
+                    # a worker that died without aborting the barrier would
+                    # leave the others waiting forever
+                    barrier.abort()
+        if any(process.exitcode != 0 for process in processes):
+            raise RuntimeError("An erosion worker failed")
+        return fields["z"].copy(), fields["h"].copy(), fields["s"].copy()
+    finally:
+        fields = None
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+def _shared_array(blocks, shape, dtype):
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _strip_worker(layout, j0, j1, barrier, num_iterations, dt, k_c, k_s, k_d, k_e, erosion_flag):
+    """
+    Step rows j0 to j1 of a distributed run, see erode_distributed.
+    """
+    blocks = {name: shared_memory.SharedMemory(name=block) for name, (block, _, _) in layout.items()}
+    f = {name: np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf) for name, (_, shape, dtype) in layout.items()}
+    rain = _pattern_views(f["rain"])
+    try:
+        for i in range(num_iterations):
+            if HAS_NUMBA:
+                _rain_strip(f["z"], f["h"], rain[i % 4], f["H"], f["h1"], dt, j0, j1)
+            else:
+                _rain_rows(f["z"], f["h"], rain[i % 4], f["H"], f["h1"], dt, j0, j1)
+            # fluxes read the surface height of the neighboring rows
+            barrier.wait()
+            if HAS_NUMBA:
+                _flux_strip(f["H"], f["h1"], f["fL"], f["fR"], f["fT"], f["fB"], dt, j0, j1)
+            else:
+                _flux_rows(f["H"], f["h1"], f["fL"], f["fR"], f["fT"], f["fB"], dt, j0, j1)
+                _edge_rows(f["fL"], f["fR"], f["fT"], f["fB"], j0, j1)
+            # water and erosion read the fluxes of the neighboring rows
+            barrier.wait()
+            if HAS_NUMBA:
+                _water_strip(f["z"], f["s"], f["fL"], f["fR"], f["fT"], f["fB"], f["h1"], f["h2"], f["u"], f["v"],
+                             f["s1"], f["g"], f["z1"], dt, k_c, k_s, k_d, SOIL_CAP, erosion_flag, j0, j1)
+            else:
+                _water_rows(f["z"], f["s"], f["fL"], f["fR"], f["fT"], f["fB"], f["h1"], f["h2"], f["u"], f["v"],
+                            f["s1"], f["g"], f["z1"], None, dt, k_c, k_s, k_d, SOIL_CAP, erosion_flag, j0, j1)
+            # advection reads eroded sediment from anywhere upstream and the
+            # next water stage reads the terrain of the neighboring rows
+            barrier.wait()
+            if not erosion_flag:
+                continue
+            if HAS_NUMBA:
+                _advect_strip(f["z"], f["h"], f["s"], f["h2"], f["u"], f["v"], f["s1"], f["z1"], dt, k_e, j0, j1)
+            else:
+                _advect_rows(f["z"], f["h"], f["s"], f["h2"], f["u"], f["v"], f["s1"], None, f["z1"], None,
+                             dt, k_e, j0, j1)
+    except threading.BrokenBarrierError:
+        # another worker failed and has reported it
+        raise SystemExit(1)
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        f = rain = None
+        for block in blocks.values():
+            block.close()
+
+def snapshot_steps(snapshots, num_iterations):
+    """
+    Steps at which erode keeps the state of the simulation, where step i
+    is the state after i iterations.
+
+    Args:
+    - snapshots: None or "none" to keep nothing, "final" for the state
+      after the last iteration, an int N for every N-th step before it,
+      or a list of steps between 0 and num_iterations
+    - num_iterations: number of erosion iterations, None for an open-ended
+      run (erode then adds every-N steps while it runs)
+
+    Returns:
+    - steps: sorted 1D numpy array of steps
+    """
+    if snapshots is None or snapshots == "none":
+        return np.zeros(0, dtype=np.int64)
+    if isinstance(snapshots, str):
+        if snapshots != "final":
+            raise ValueError(f"Unknown snapshot policy {snapshots!r}")
+        # the last step of an open-ended run is only known at its end, a step
+        # it cannot reach is filled with the final state
+        last = np.iinfo(np.int64).max if num_iterations is None else num_iterations
+        return np.array([last], dtype=np.int64)
+    if np.ndim(snapshots) == 0:
+        if snapshots < 1:
+            raise ValueError("The snapshot interval must be at least 1")
+        if num_iterations is None:
+            raise ValueError("Every-N snapshots of an open-ended run are only known as it runs")
+        return np.arange(0, num_iterations, snapshots, dtype=np.int64)
+    steps = np.unique(np.asarray(snapshots, dtype=np.int64))
+    if len(steps) and steps[0] < 0:
+        raise ValueError("Snapshot steps must not be negative")
+    if len(steps) and num_iterations is not None and steps[-1] > num_iterations:
+        raise ValueError(f"Snapshot steps must be between 0 and {num_iterations}")
+    return steps
+
+def _is_interval(snapshots):
+    return snapshots is not None and not isinstance(snapshots, str) and np.ndim(snapshots) == 0
+
+def _resize_snapshots(snapshot_file, name, saved, n):
+    """
+    Snapshot buffer of n frames starting with the frames of saved,
+    rewriting the file on disk.
+    """
+    shape = (n,) + saved.shape[1:]
+    k = min(n, len(saved))
+    if snapshot_file is None:
+        resized = np.empty(shape, dtype=saved.dtype)
+        resized[:k] = saved[:k]
+        return resized
+    path = f"{snapshot_file}_{name}.npy"
+    resized = np.lib.format.open_memmap(f"{path}.tmp", mode="w+", dtype=saved.dtype, shape=shape)
+    resized[:k] = saved[:k]
+    resized.flush()
+    os.replace(f"{path}.tmp", path)
+    return resized
+
+def _snapshot_buffer(snapshot_file, name, steps, z):
+    """
+    Array holding one field at every snapshot step, in memory or on disk.
+    """
+    shape = (len(steps),) + z.shape
+    if snapshot_file is None:
+        return np.empty(shape, dtype=z.dtype)
+    return np.lib.format.open_memmap(f"{snapshot_file}_{name}.npy", mode="w+", dtype=z.dtype, shape=shape)
+
+@njit
 def add_water_droplets(h, droplet_positions, droplet_mask):
-    for i in prange(len(droplet_positions)):
+    """
+    Add a droplet mask to h at every position. Droplets may overlap, so
+    they are added one after another.
+    """
+    for i in range(len(droplet_positions)):
         cx, cy = droplet_positions[i]
         h[cx:cx+droplet_mask.shape[0], cy:cy+droplet_mask.shape[1]] += droplet_mask
     return h
@@ -336,9 +1430,14 @@ def add_water_droplets(h, droplet_positions, droplet_mask):
 def rotate_array(arr, k):
     return np.rot90(arr, k)
 
-def precompute_droplets(shape, num_droplets, R):
+def precompute_droplets(shape, num_droplets, R, rng=None):
+    """
+    Draw droplet positions (top left corners) and the droplet mask of
+    radius R. rng is a numpy Generator or a seed for one.
+    """
+    rng = np.random.default_rng(rng)
     x, y = shape
-    droplet_positions = np.array([(np.random.randint(0, x-2*R), np.random.randint(0, y-2*R)) for _ in range(num_droplets)])
+    droplet_positions = rng.integers(0, (x - 2*R, y - 2*R), size=(num_droplets, 2))
     y_grid, x_grid = np.ogrid[-R:R+1, -R:R+1]
     droplet_mask = np.where(x_grid**2 + y_grid**2 <= R**2, 0.1, 0).astype(np.float32)
     return droplet_positions, droplet_mask
\ No newline at end of file
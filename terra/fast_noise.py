@@ -0,0 +1,112 @@
+"""
+Compiled, multi-core noise kernels.
+
+These mirror the NumPy implementations in terra.randd and are selected with
+`backend="numba"` (or by setting `terra.randd.BACKEND`). Rows of the output
+are split across cores and all octaves are accumulated in a single pass over
+the output buffer.
+"""
+import math
+import numpy as np
+from numba import njit, prange
+
+@njit
+def _fade(t):
+    return t * t * t * (t * (t * 6 - 15) + 10)
+
+@njit
+def _lerp(t, a, b):
+    return a + t * (b - a)
+
+@njit
+def _grad(hash, x, y, grad_x, grad_y):
+    h = hash & 15
+    return grad_x[h] * x + grad_y[h] * y
+
+@njit
+def _noise2d(p, x, y, grad_x, grad_y):
+    xi = int(math.floor(x))
+    yi = int(math.floor(y))
+    x -= xi
+    y -= yi
+    xi &= 255
+    yi &= 255
+    u = _fade(x)
+    v = _fade(y)
+    A = p[xi] + yi
+    B = p[xi + 1] + yi
+    return _lerp(v,
+                 _lerp(u, _grad(p[A], x, y, grad_x, grad_y), _grad(p[B], x - 1, y, grad_x, grad_y)),
+                 _lerp(u, _grad(p[A + 1], x, y - 1, grad_x, grad_y), _grad(p[B + 1], x - 1, y - 1, grad_x, grad_y)))
+
+@njit(parallel=True)
+def perlin_fbm(p, X, Y, x0, y0, freqs, amplitudes, grad_x, grad_y, out):
+    """
+    Accumulate all octaves of Perlin noise into `out` (shape (Y, X)).
+
+    Args:
+    p: numpy array - doubled permutation table
+    X, Y: int - dimensions of the heightmap
+    x0, y0: int - world coordinates of the top left pixel
+    freqs: numpy array - frequency of each octave
+    amplitudes: numpy array - amplitude of each octave
+    grad_x, grad_y: numpy arrays - gradient coefficient tables
+    out: numpy array - output buffer, overwritten
+    """
+    for y in prange(Y):
+        wy = y0 + y
+        for x in range(X):
+            wx = x0 + x
+            value = 0.0
+            for o in range(freqs.shape[0]):
+                value += amplitudes[o] * _noise2d(p, wx * freqs[o], wy * freqs[o], grad_x, grad_y)
+            out[y, x] = value
+    return out
+
+@njit
+def _simplex_corner(gx, gy, corner, x, y):
+    t = max(0.5 - x * x - y * y, 0.0)
+    t *= t
+    return t * t * (gx[corner] * x + gy[corner] * y)
+
+@njit
+def _simplex2d(p, gx, gy, x, y, F2, G2):
+    s = (x + y) * F2
+    i = np.floor(x + s)
+    j = np.floor(y + s)
+    t = (i + j) * G2
+    x0 = x - i + t
+    y0 = y - j + t
+    i1 = int(x0 > y0)
+    j1 = 1 - i1
+    i = int(i) & 255
+    j = int(j) & 255
+    n = _simplex_corner(gx, gy, p[j] + i, x0, y0)
+    n += _simplex_corner(gx, gy, p[j + j1] + i + i1, x0 - i1 + G2, y0 - j1 + G2)
+    n += _simplex_corner(gx, gy, p[j + 1] + i + 1, x0 - 1.0 + 2.0 * G2, y0 - 1.0 + 2.0 * G2)
+    return 70.0 * n
+
+@njit(parallel=True)
+def simplex_fbm(p, gx, gy, X, Y, x0, y0, freqs, amplitudes, F2, G2, out):
+    """
+    Accumulate all octaves of simplex noise into `out` (shape (Y, X)).
+
+    Args:
+    p: numpy array - doubled permutation table
+    gx, gy: numpy arrays - gradient coefficients of every entry of p
+    X, Y: int - dimensions of the heightmap
+    x0, y0: int - world coordinates of the top left pixel
+    freqs: numpy array - frequency of each octave
+    amplitudes: numpy array - amplitude of each octave
+    F2, G2: float - skewing factors of the simplex grid
+    out: numpy array - output buffer, overwritten
+    """
+    for y in prange(Y):
+        wy = y0 + y
+        for x in range(X):
+            wx = x0 + x
+            value = 0.0
+            for o in range(freqs.shape[0]):
+                value += amplitudes[o] * _simplex2d(p, gx, gy, wx * freqs[o], wy * freqs[o], F2, G2)
+            out[y, x] = value
+    return out
@@ -1,10 +1,26 @@
 import numpy as np
 import math
+from terra._compat import njit, prange
 from tqdm import tqdm
+from terra import get_dtype
+
+# Droplets simulated per call into the compiled kernel (and progress update)
+CHUNK_SIZE = 1000
+PARALLEL_CHUNK_SIZE = 100000
+
+# Philox4x32-10 constants (Salmon et al., "Parallel random numbers: as easy
+# as 1, 2, 3", 2011)
+PHILOX_M0 = np.uint64(0xD2511F53)
+PHILOX_M1 = np.uint64(0xCD9E8D57)
+PHILOX_W0 = np.uint64(0x9E3779B9)
+PHILOX_W1 = np.uint64(0xBB67AE85)
+MASK32 = np.uint64(0xFFFFFFFF)
+SHIFT32 = np.uint64(32)
 
 def erode(heightmap, num_iterations=1, seed=None, erosion_radius=5, inertia=0.25, sediment_capacity_factor=20,
           min_sediment_capacity=0.01, erode_speed=0.7, deposit_speed=0.2, evaporate_speed=0.05, gravity=10,
-          max_droplet_lifetime=30, initial_water_volume=2, initial_speed=1):
+          max_droplet_lifetime=30, initial_water_volume=2, initial_speed=1, dtype=None,
+          parallel=False, first_droplet=0):
     """
     Simulates hydraulic erosion on a heightmap using independent water droplets.
     References:
@@ -15,7 +31,9 @@ def erode(heightmap, num_iterations=1, seed=None, erosion_radius=5, inertia=0.25
     Args:
     - heightmap (numpy.ndarray): The heightmap to erode.
     - num_iterations (int): The number of droplets to simulate.
-    - seed (int): The seed for the random number generator.
+    - seed (int): The seed for the random number generator. Droplet i draws
+      its spawn point from a counter-based generator keyed by (seed, i), so
+      a seed gives the same terrain however the droplets are scheduled.
     - erosion_radius (int): The radius of the erosion brush.
     - inertia (float): The inertia of the droplet.
     - sediment_capacity_factor (float): The factor that determines the sediment capacity 
@@ -28,105 +46,138 @@ def erode(heightmap, num_iterations=1, seed=None, erosion_radius=5, inertia=0.25
     - max_droplet_lifetime (int): The maximum lifetime of the droplet.
     - initial_water_volume (float): The initial water volume of the droplet.
     - initial_speed (float): The initial speed of the droplet.
+    - dtype (numpy.dtype): Floating point type of the maps, defaults to terra.DTYPE.
+    - parallel (bool): Simulate many droplets at once on all cores. The map is
+      split into tiles larger than the reach of a droplet and tiles are run
+      in four checkerboard phases, so concurrent droplets never touch the
+      same nodes. Results are independent of the number of threads and
+      statistically equivalent to the serial mode, which runs droplets in
+      spawn order. Falls back to serial on maps too small to tile.
+    - first_droplet (int): Index of the first droplet, to resume a bake that
+      stopped after `first_droplet` droplets without replaying them.
 
     Returns:
     - heightmap (numpy.ndarray): The eroded heightmap.
     - path_map (numpy.ndarray): The map of water droplet paths.    
     """
     mapSize = heightmap.shape[0]
-    rng = np.random.default_rng(seed)
-    erosion_brush_indices, erosion_brush_weights = initialize_brush_indices(mapSize, erosion_radius)
-    heightmap = heightmap.copy()
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1, np.uint64)[0])
+    brush = initialize_brush(erosion_radius)
+    heightmap = heightmap.astype(get_dtype(dtype))
     path_map = np.zeros_like(heightmap)
 
-    for _ in tqdm(range(num_iterations)):
-        pos_x = rng.uniform(0, mapSize - 1)
-        pos_y = rng.uniform(0, mapSize - 1)
-        dir_x, dir_y = 0, 0
-        speed = initial_speed
-        water = initial_water_volume
-        sediment = 0
-
-        '''     
-        for lifetime in range(max_droplet_lifetime):
-            node_x, node_y = int(pos_x), int(pos_y)
-            droplet_index = node_y * mapSize + node_x
-            cell_offset_x, cell_offset_y = pos_x - node_x, pos_y - node_y
-
-            path_map[node_y, node_x] += 1
-
-            height, gradient_x, gradient_y = calculate_height_and_gradient(heightmap, mapSize, pos_x, pos_y)
-
-            dir_x = (dir_x * inertia - gradient_x * (1 - inertia))
-            dir_y = (dir_y * inertia - gradient_y * (1 - inertia))
-            
-            length = math.sqrt(dir_x * dir_x + dir_y * dir_y)
-            if length != 0:
-                dir_x /= length
-                dir_y /= length
-            
-            pos_x += dir_x
-            pos_y += dir_y
-
-            # Implement periodic boundary conditions
-            pos_x = pos_x % mapSize
-            pos_y = pos_y % mapSize
-
-            new_height, _, _ = calculate_height_and_gradient(heightmap, mapSize, pos_x, pos_y)
-            delta_height = new_height - height
-
-            sediment_capacity = max(-delta_height * speed * water * sediment_capacity_factor, min_sediment_capacity)
-
-            """
-            # CLAUDE! Please rethink this part of the code
-            # so that the sediment is deposited in the correct location etc.          
-            if sediment > sediment_capacity or delta_height > 0:
-                amount_to_deposit = max(delta_height, sediment) if delta_height > 0 else (sediment - sediment_capacity) * deposit_speed
-                sediment -= amount_to_deposit
-
-                heightmap += deposit_to_node(heightmap, pos_x, pos_y, amount_to_deposit, mapSize)
-            else:
-                amount_to_erode = min((sediment_capacity - sediment) * erode_speed, -delta_height)
+    params = brush + (erosion_radius, inertia, sediment_capacity_factor, min_sediment_capacity,
+                      erode_speed, deposit_speed, evaporate_speed, gravity, max_droplet_lifetime,
+                      initial_water_volume, initial_speed)
+    # a droplet moves at most one node per step, touches the node after its
+    # position and erodes within the brush radius around it, tiles must be
+    # wider than twice that reach
+    reach = max_droplet_lifetime + 2 + erosion_radius
+    n_tiles = 2 * (mapSize // (2 * (2 * reach + 1)))
+    parallel = parallel and n_tiles >= 2
+    chunk_size = PARALLEL_CHUNK_SIZE if parallel else CHUNK_SIZE
+
+    for start in tqdm(range(0, num_iterations, chunk_size)):
+        spawn = droplet_spawns(seed, first_droplet + start, min(chunk_size, num_iterations - start), mapSize)
+        if parallel:
+            spawn, offsets = _sort_into_tiles(spawn, mapSize, n_tiles)
+            _simulate_tiled(heightmap, path_map, spawn, offsets, n_tiles, *params)
+        else:
+            _simulate_droplets(heightmap, path_map, spawn, *params)
 
-                for brush_point_index in range(len(erosion_brush_indices[droplet_index])):
-                    node_index = erosion_brush_indices[droplet_index][brush_point_index]
-                    weighed_erode_amount = amount_to_erode * erosion_brush_weights[droplet_index][brush_point_index]
-                    delta_sediment = min(heightmap.flat[node_index], weighed_erode_amount)
-                    heightmap.flat[node_index] -= delta_sediment
-                    sediment += delta_sediment
-            """
-
-            if sediment > sediment_capacity or delta_height > 0:
-                # If moving uphill or carrying too much sediment, deposit it
-                amount_to_deposit = (delta_height > 0) * delta_height + (sediment - sediment_capacity) * deposit_speed
-                amount_to_deposit = min(amount_to_deposit, sediment)
-                sediment -= amount_to_deposit
+    return heightmap, path_map
 
-                # Deposit sediment to the current cell and its neighbors
-                heightmap = deposit_to_node(heightmap, pos_x, pos_y, amount_to_deposit, mapSize)
-            else:
-                # Erode the surface
-                amount_to_erode = min((sediment_capacity - sediment) * erode_speed, -delta_height)
-                
-                # Distribute erosion across the brush
-                for brush_point_index in range(len(erosion_brush_indices[droplet_index])):
-                    node_index = erosion_brush_indices[droplet_index][brush_point_index]
-                    weighed_erode_amount = amount_to_erode * erosion_brush_weights[droplet_index][brush_point_index]
-                    delta_sediment = min(heightmap.flat[node_index], weighed_erode_amount)
-                    heightmap.flat[node_index] -= delta_sediment
-                    sediment += delta_sediment
-
-            # Update water volume and sediment based on speed
-            water = water * (1 - evaporate_speed)
-            if speed != 0:
-                sediment = min(sediment, sediment_capacity)
-
-            #speed = math.sqrt(max(0, speed * speed + delta_height * gravity))
-            #water *= (1 - evaporate_speed)'''
+def droplet_spawns(seed, first, count, map_size):
+    """
+    Spawn points (x, y) of droplets first..first+count-1, uniform in
+    [0, map_size - 1). Each droplet's point only depends on the seed and the
+    droplet's index.
+    """
+    seed = int(seed) & 0xFFFFFFFFFFFFFFFF
+    spawn = np.empty((count, 2))
+    _philox_uniforms(np.uint64(seed & 0xFFFFFFFF), np.uint64(seed >> 32), first, spawn)
+    spawn *= map_size - 1
+    return spawn
+
+@njit(parallel=True)
+def _philox_uniforms(k0, k1, first, out):
+    # droplet index is the counter, each block gives two 53-bit doubles
+    for n in prange(out.shape[0]):
+        i = np.uint64(first + n)
+        c0, c1, c2, c3 = philox4x32(i & MASK32, i >> SHIFT32, np.uint64(0), np.uint64(0), k0, k1)
+        out[n, 0] = _to_unit(c0, c1)
+        out[n, 1] = _to_unit(c2, c3)
+
+@njit
+def _to_unit(a, b):
+    return ((a >> np.uint64(5)) * 67108864.0 + (b >> np.uint64(6))) / 9007199254740992.0
+
+@njit
+def philox4x32(c0, c1, c2, c3, k0, k1):
+    """
+    Philox4x32-10 counter-based generator: maps a 128 bit counter and a 64
+    bit key (as 32 bit words in uint64s) to four random 32 bit words.
+    """
+    for _ in range(10):
+        p0 = PHILOX_M0 * c0
+        p1 = PHILOX_M1 * c2
+        c0, c1, c2, c3 = ((p1 >> SHIFT32) ^ c1 ^ k0, p1 & MASK32,
+                          (p0 >> SHIFT32) ^ c3 ^ k1, p0 & MASK32)
+        k0 = (k0 + PHILOX_W0) & MASK32
+        k1 = (k1 + PHILOX_W1) & MASK32
+    return c0, c1, c2, c3
+
+def _sort_into_tiles(spawn, map_size, n_tiles):
+    """
+    Stable-sort spawn points by tile (row-major tile index) and return them
+    with the offsets of every tile's droplets.
+    """
+    tile = np.minimum((spawn * (n_tiles / map_size)).astype(np.int64), n_tiles - 1)
+    tile = tile[:, 1] * n_tiles + tile[:, 0]
+    order = np.argsort(tile, kind="stable")
+    offsets = np.searchsorted(tile[order], np.arange(n_tiles * n_tiles + 1))
+    return spawn[order], offsets
+
+@njit(parallel=True)
+def _simulate_tiled(heightmap, path_map, spawn, offsets, n_tiles, brush_dy, brush_dx, brush_w,
+                    erosion_radius, inertia, sediment_capacity_factor,
+                    min_sediment_capacity, erode_speed, deposit_speed, evaporate_speed,
+                    gravity, max_droplet_lifetime, initial_water_volume, initial_speed):
+    """
+    Runs the droplets of every tile, tiles of one checkerboard phase in
+    parallel and the four phases one after another.
+    """
+    half = n_tiles // 2
+    for phase in range(4):
+        for k in prange(half * half):
+            tile = (2 * (k // half) + phase // 2) * n_tiles + 2 * (k % half) + phase % 2
+            _simulate_droplets(heightmap, path_map, spawn[offsets[tile]:offsets[tile + 1]],
+                               brush_dy, brush_dx, brush_w, erosion_radius,
+                               inertia, sediment_capacity_factor, min_sediment_capacity,
+                               erode_speed, deposit_speed, evaporate_speed, gravity,
+                               max_droplet_lifetime, initial_water_volume, initial_speed)
+
+@njit
+def _simulate_droplets(heightmap, path_map, spawn, brush_dy, brush_dx, brush_w,
+                       erosion_radius, inertia, sediment_capacity_factor,
+                       min_sediment_capacity, erode_speed, deposit_speed, evaporate_speed,
+                       gravity, max_droplet_lifetime, initial_water_volume, initial_speed):
+    """
+    Runs the full lifecycle of one droplet per row of `spawn` (x, y), one
+    after another, updating heightmap and path_map in place.
+    """
+    mapSize = heightmap.shape[0]
+    for d in range(spawn.shape[0]):
+        pos_x = spawn[d, 0]
+        pos_y = spawn[d, 1]
+        dir_x, dir_y = 0.0, 0.0
+        speed = float(initial_speed)
+        water = float(initial_water_volume)
+        sediment = 0.0
 
         for lifetime in range(max_droplet_lifetime):
             node_x, node_y = int(pos_x), int(pos_y)
-            droplet_index = node_y * mapSize + node_x
             cell_offset_x, cell_offset_y = pos_x - node_x, pos_y - node_y
 
             path_map[node_y, node_x] += 1
@@ -169,13 +220,22 @@ def erode(heightmap, num_iterations=1, seed=None, erosion_radius=5, inertia=0.25
                 # Erode
                 amount_to_erode = min((sediment_capacity - sediment) * erode_speed, -delta_height)
                 
-                # Erode from the current cell and its neighbors
-                heightmap[node_y, node_x] -= amount_to_erode * (1 - cell_offset_x) * (1 - cell_offset_y)
-                heightmap[node_y, (node_x + 1) % mapSize] -= amount_to_erode * cell_offset_x * (1 - cell_offset_y)
-                heightmap[(node_y + 1) % mapSize, node_x] -= amount_to_erode * (1 - cell_offset_x) * cell_offset_y
-                heightmap[(node_y + 1) % mapSize, (node_x + 1) % mapSize] -= amount_to_erode * cell_offset_x * cell_offset_y
-                
-                sediment += amount_to_erode
+                # Distribute erosion across the brush around the current node,
+                # never taking more than a node has. Near the border the brush
+                # is clipped to the map and its weights are renormalized.
+                weight_sum = 1.0
+                if min(node_x, node_y, mapSize - 1 - node_x, mapSize - 1 - node_y) < erosion_radius - 1:
+                    weight_sum = 0.0
+                    for b in range(brush_w.shape[0]):
+                        y, x = node_y + brush_dy[b], node_x + brush_dx[b]
+                        if 0 <= y < mapSize and 0 <= x < mapSize:
+                            weight_sum += brush_w[b]
+                for b in range(brush_w.shape[0]):
+                    y, x = node_y + brush_dy[b], node_x + brush_dx[b]
+                    if 0 <= y < mapSize and 0 <= x < mapSize:
+                        delta_sediment = min(heightmap[y, x], amount_to_erode * brush_w[b] / weight_sum)
+                        heightmap[y, x] -= delta_sediment
+                        sediment += delta_sediment
 
             # Update droplet's speed and water content
             speed = math.sqrt(max(0, speed * speed + delta_height * gravity))
@@ -188,8 +248,6 @@ def erode(heightmap, num_iterations=1, seed=None, erosion_radius=5, inertia=0.25
             if (dir_x == 0 and dir_y == 0) or water <= 0:
                 break
 
-    return heightmap, path_map
-
 def deposit_to_node(heightmap, pos_x, pos_y, amount, mapSize):
     """
     Calculates the amount of sediment to deposit to the four nodes of the cell.
@@ -205,18 +263,20 @@ def deposit_to_node(heightmap, pos_x, pos_y, amount, mapSize):
 
     return heightmap
 
+@njit
 def calculate_height_and_gradient(nodes, map_size, pos_x, pos_y):
     """
     Calculates the height and gradient at a given position on the heightmap.
     """
     coord_x, coord_y = int(pos_x), int(pos_y)
     x, y = pos_x - coord_x, pos_y - coord_y
-    # Get the heights of the four nodes of the cell
-    node_index_nw = coord_y * map_size + coord_x
-    height_nw = nodes.flat[node_index_nw]
-    height_ne = nodes.flat[min(node_index_nw + 1, nodes.size - 1)]
-    height_sw = nodes.flat[min(node_index_nw + map_size, nodes.size - 1)]
-    height_se = nodes.flat[min(node_index_nw + map_size + 1, nodes.size - 1)]
+    # Get the heights of the four nodes of the cell, wrapping around the
+    # borders like the droplet positions do
+    next_x, next_y = (coord_x + 1) % map_size, (coord_y + 1) % map_size
+    height_nw = nodes[coord_y, coord_x]
+    height_ne = nodes[coord_y, next_x]
+    height_sw = nodes[next_y, coord_x]
+    height_se = nodes[next_y, next_x]
     # Calculate the gradient
     gradient_x = (height_ne - height_nw) * (1 - y) + (height_se - height_sw) * y
     gradient_y = (height_sw - height_nw) * (1 - x) + (height_se - height_ne) * x
@@ -224,38 +284,22 @@ def calculate_height_and_gradient(nodes, map_size, pos_x, pos_y):
     height = height_nw * (1 - x) * (1 - y) + height_ne * x * (1 - y) + height_sw * (1 - x) * y + height_se * x * y
     return height, gradient_x, gradient_y
 
-def initialize_brush_indices(map_size, radius):
+def initialize_brush(radius):
     """
-    This function initializes the indices and weights of the erosion brush 
+    This function initializes the offsets and weights of the erosion brush
     used to erode the terrain. The erosion brush is a circular area around
     the current droplet position that determines which nodes are eroded.
+
+    Only the interior brush is stored, its size only depends on the radius.
+    Near the border the droplet kernel skips the entries outside the map and
+    renormalizes the weights of the remaining ones.
+
+    Returns:
+    - brush_dy, brush_dx (numpy.ndarray): Node offsets of every entry.
+    - brush_w (numpy.ndarray): Normalized weight of every entry.
     """
-    erosion_brush_indices = [[] for _ in range(map_size * map_size)]
-    erosion_brush_weights = [[] for _ in range(map_size * map_size)]
-    # Iterate over all nodes in the heightmap
-    for i in range(map_size * map_size):
-        centre_x, centre_y = i % map_size, i // map_size
-        # Skip nodes near the border
-        if centre_y <= radius or centre_y >= map_size - radius or centre_x <= radius + 1 or centre_x >= map_size - radius:
-            weight_sum = 0
-            add_index = 0
-            x_offsets, y_offsets, weights = [], [], []
-            # Iterate over the nodes in the erosion brush
-            for y in range(-radius, radius + 1):
-                for x in range(-radius, radius + 1):
-                    sqr_dst = x * x + y * y
-                    if sqr_dst < radius * radius:
-                        coord_x, coord_y = centre_x + x, centre_y + y
-                        # Check if the node is within the heightmap bounds
-                        if 0 <= coord_x < map_size and 0 <= coord_y < map_size:
-                            weight = 1 - math.sqrt(sqr_dst) / radius
-                            weight_sum += weight
-                            weights.append(weight)
-                            x_offsets.append(x)
-                            y_offsets.append(y)
-                            add_index += 1
-            # Normalize the weights
-            for j in range(add_index):
-                erosion_brush_indices[i].append((y_offsets[j] + centre_y) * map_size + x_offsets[j] + centre_x)
-                erosion_brush_weights[i].append(weights[j] / weight_sum)
-    return erosion_brush_indices, erosion_brush_weights
+    y, x = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    inside = x * x + y * y < radius * radius
+    dy, dx = y[inside], x[inside]
+    weight = 1 - np.sqrt(dx * dx + dy * dy) / radius
+    return dy.astype(np.int64), dx.astype(np.int64), weight / weight.sum()
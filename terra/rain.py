@@ -0,0 +1,181 @@
+"""
+Precipitation schedules for terra.fast_erosion.
+
+A RainSchedule sums a list of rain sources into one reused buffer and is
+passed to erode (or ErosionSolver.iterate) as `rain`. Every source is a pure
+function of the iteration, so a run resumed from a checkpoint sees the same
+rain as an uninterrupted one. Sources precompute everything that does not
+depend on the iteration; a step only costs a few array additions.
+
+Example:
+    rain = RainSchedule(z.shape, UniformRain(0.002), StormCells(z.shape, count=3))
+    saved_z, saved_h, s, saved_r = erode(z, num_iterations=500, rain=rain)
+"""
+import numpy as np
+from terra import get_dtype
+from terra.randd import perlin
+from terra._compat import njit
+from terra.fast_erosion import cycle_patterns
+
+@njit
+def _add_stamps(out, stamp, centers, weights):
+    """
+    Add weights[i] * stamp centered on centers[i] to out, wrapping around
+    the map edges. Stamps may overlap, so they are added one after another.
+    """
+    n_y, n_x = out.shape
+    r_y = stamp.shape[0] // 2
+    r_x = stamp.shape[1] // 2
+    for i in range(centers.shape[0]):
+        y0 = centers[i, 0] - r_y
+        x0 = centers[i, 1] - r_x
+        for dy in range(stamp.shape[0]):
+            y = (y0 + dy) % n_y
+            for dx in range(stamp.shape[1]):
+                x = (x0 + dx) % n_x
+                out[y, x] += weights[i] * stamp[dy, dx]
+    return out
+
+def _disc(radius, dtype):
+    """
+    Smooth (2*radius+1)^2 stamp falling from 1 in the center to 0 at radius.
+    """
+    y, x = np.ogrid[-radius:radius+1, -radius:radius+1]
+    d2 = (x**2 + y**2) / max(radius, 1)**2
+    return np.where(d2 < 1, (1 - d2)**2, 0).astype(dtype)
+
+class RainSchedule:
+    """
+    Rainfall of every iteration as the sum of rain sources.
+
+    Args:
+    - shape: (y, x) shape of the map
+    - sources: rain sources, objects with a method add(iteration, out)
+      adding their rain to out
+    - dtype: floating point type of the rain, should match the solver,
+      defaults to terra.DTYPE
+
+    Calling the schedule with an iteration returns its rainfall. The result
+    is a view of an internal buffer which the next call overwrites.
+    """
+    def __init__(self, shape, *sources, dtype=None):
+        self.sources = list(sources)
+        self.out = np.zeros(shape, dtype=get_dtype(dtype))
+
+    def __call__(self, iteration):
+        self.out.fill(0)
+        for source in self.sources:
+            source.add(iteration, self.out)
+        return self.out
+
+class UniformRain:
+    """
+    The same rainfall rate everywhere.
+    """
+    def __init__(self, rate=0.001):
+        self.rate = rate
+
+    def add(self, iteration, out):
+        out += self.rate
+
+class PatternRain:
+    """
+    Fixed rainfall pattern, cycled through its rotations (square maps) or
+    mirror images like the default rain of erode.
+
+    Args:
+    - base: 2D numpy array - rainfall pattern
+    - rate: factor the pattern is scaled by
+    - hold: number of iterations each orientation is kept
+    """
+    def __init__(self, base, rate=1.0, hold=1):
+        self.patterns = [np.ascontiguousarray(rate * p) for p in cycle_patterns(np.asarray(base))]
+        self.hold = hold
+
+    def add(self, iteration, out):
+        out += self.patterns[(iteration // self.hold) % len(self.patterns)]
+
+class NoiseRain:
+    """
+    Drifting Perlin noise rainfall. A loop of frames is generated up front
+    from consecutive windows of the noise and played back in order.
+
+    Args:
+    - shape: (y, x) shape of the map
+    - rate: largest rainfall rate
+    - scale: scale of the noise
+    - seed: random seed of the noise
+    - frames: number of frames in the loop
+    - hold: number of iterations each frame is kept
+    - drift: (dy, dx) pixels the noise moves between frames
+    - dtype: floating point type, defaults to terra.DTYPE
+    """
+    def __init__(self, shape, rate=0.002, scale=64, seed=0, frames=16, hold=10, drift=(0, 4),
+                 dtype=None):
+        dtype = get_dtype(dtype)
+        Y, X = shape
+        self.frames = np.empty((frames, Y, X), dtype=dtype)
+        for k in range(frames):
+            perlin(X, Y, scale=scale, seed=seed, x0=k*drift[1], y0=k*drift[0],
+                   normalize="fixed", dtype=dtype, out=self.frames[k])
+            self.frames[k] *= rate
+        self.hold = hold
+
+    def add(self, iteration, out):
+        out += self.frames[(iteration // self.hold) % len(self.frames)]
+
+class StormCells:
+    """
+    Round storm cells moving across the map at constant velocity, wrapping
+    around the edges.
+
+    Args:
+    - shape: (y, x) shape of the map
+    - count: number of storm cells
+    - radius: radius of a cell in pixels
+    - intensity: rainfall rate in the center of a cell
+    - speed: pixels a cell moves per iteration
+    - seed: random seed of the start positions and directions
+    - dtype: floating point type, defaults to terra.DTYPE
+    """
+    def __init__(self, shape, count=4, radius=16, intensity=0.02, speed=0.5, seed=0, dtype=None):
+        rng = np.random.default_rng(seed)
+        self.shape = np.array(shape)
+        self.start = rng.uniform(0, 1, (count, 2)) * self.shape
+        angle = rng.uniform(0, 2*np.pi, count)
+        self.velocity = speed * np.stack((np.sin(angle), np.cos(angle)), axis=1)
+        self.stamp = _disc(radius, get_dtype(dtype))
+        self.weights = np.full(count, intensity, dtype=self.stamp.dtype)
+
+    def add(self, iteration, out):
+        centers = np.floor(self.start + iteration * self.velocity).astype(np.int64) % self.shape
+        _add_stamps(out, self.stamp, centers, self.weights)
+
+class DropletBursts:
+    """
+    Bursts of droplets at random positions. The positions of an iteration
+    are drawn from a generator seeded with (seed, iteration).
+
+    Args:
+    - shape: (y, x) shape of the map
+    - count: number of droplets per burst
+    - radius: radius of a droplet in pixels
+    - amount: water added in the center of a droplet
+    - every: number of iterations between bursts
+    - seed: random seed of the positions
+    - dtype: floating point type, defaults to terra.DTYPE
+    """
+    def __init__(self, shape, count=10, radius=5, amount=0.1, every=1, seed=0, dtype=None):
+        self.shape = shape
+        self.count = count
+        self.every = every
+        self.seed = seed
+        self.stamp = _disc(radius, get_dtype(dtype))
+        self.weights = np.full(count, amount, dtype=self.stamp.dtype)
+
+    def add(self, iteration, out):
+        if iteration % self.every:
+            return
+        rng = np.random.default_rng((self.seed, iteration))
+        centers = rng.integers(0, self.shape, size=(self.count, 2))
+        _add_stamps(out, self.stamp, centers, self.weights)
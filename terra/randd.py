@@ -1,9 +1,35 @@
+import math
 import numpy as np
-from scipy.ndimage import map_coordinates
+from functools import lru_cache
+from terra import get_dtype
+from scipy.ndimage import map_coordinates, zoom
 
-def generate_permutation(n):
+# Default noise backend: "numpy" (vectorized reference) or "numba"
+# (compiled, multi-core, see terra.fast_noise).
+BACKEND = "numpy"
+
+def generate_permutation(n, seed=None):
+    """
+    Return a doubled permutation table of length 2n for the given seed.
+
+    Every table is shuffled by its own RandomState, so the global NumPy RNG
+    is left untouched and concurrent calls from several threads are safe.
+    Seeded tables are cached and returned read-only; seed=None gives a fresh
+    random table on every call.
+    """
+    if seed is None:
+        return _shuffled_permutation(n, np.random.RandomState())
+    return _cached_permutation(n, seed)
+
+@lru_cache(maxsize=64)
+def _cached_permutation(n, seed):
+    perm = _shuffled_permutation(n, np.random.RandomState(seed))
+    perm.flags.writeable = False
+    return perm
+
+def _shuffled_permutation(n, rng):
     perm = np.arange(n, dtype=np.int32)
-    np.random.shuffle(perm)
+    rng.shuffle(perm)
     return np.concatenate((perm, perm))
 
 def fade(t):
@@ -12,15 +38,54 @@ def fade(t):
 def lerp(t, a, b):
     return a + t * (b - a)
 
+# Gradient directions selected by the low 4 bits of a lattice hash,
+# written as coefficients of (x, y) so they can be gathered for whole grids.
+GRAD_X = np.array([1, -1, 1, -1, 1, -1, 1, -1, 0, 0, 0, 0, 1, 0, -1, 0], dtype=np.int8)
+GRAD_Y = np.array([1, 1, -1, -1, 0, 0, 0, 0, 1, -1, 1, -1, 1, -1, 1, -1], dtype=np.int8)
+
 def grad(hash, x, y):
     h = hash & 15
-    u = x if h < 8 else y
-    v = y if h < 4 else (x if h in [12, 14] else 0)
-    return (u if (h & 1) == 0 else -u) + (v if (h & 2) == 0 else -v)
+    return GRAD_X[h] * x + GRAD_Y[h] * y
+
+def noise2d(p, x, y, dtype=np.float64):
+    """
+    Evaluate 2D Perlin noise on a grid.
 
-def perlin(X, Y, scale=10, octaves=1, persistence=0.5, lacunarity=2.0, seed=None):
+    Args:
+    p: numpy array - doubled permutation table
+    x: numpy array - sample coordinates along the horizontal axis, shape (X,)
+    y: numpy array - sample coordinates along the vertical axis, shape (Y,)
+    dtype: numpy dtype - floating point type of the result
+
+    Returns:
+    numpy array of shape (Y, X)
+    """
+    # Lattice cell and position inside the cell. Everything that only depends
+    # on one axis is computed once per row/column and broadcast.
+    xi = np.floor(x).astype(np.int64)
+    yi = np.floor(y).astype(np.int64)
+    xf = (x - xi).astype(dtype, copy=False)[np.newaxis, :]
+    yf = (y - yi).astype(dtype, copy=False)[:, np.newaxis]
+    u = fade(xf)
+    v = fade(yf)
+    xi &= 255
+    yi &= 255
+    A = p[xi][np.newaxis, :] + yi[:, np.newaxis]
+    B = p[xi + 1][np.newaxis, :] + yi[:, np.newaxis]
+    return lerp(v,
+                lerp(u, grad(p[A], xf, yf), grad(p[B], xf - 1, yf)),
+                lerp(u, grad(p[A + 1], xf, yf - 1), grad(p[B + 1], xf - 1, yf - 1)))
+
+def perlin(X, Y, scale=10, octaves=1, persistence=0.5, lacunarity=2.0, seed=None, backend=None,
+           x0=0, y0=0, normalize="minmax", dtype=None, out=None):
     """
     Generate a Perlin noise heightmap.
+
+    The noise is a function of world coordinates: the returned window covers
+    pixels x0..x0+X-1 and y0..y0+Y-1. With normalize="fixed" and a fixed seed,
+    any rectangle of the (unbounded) world gives the same values no matter
+    how it is tiled, so tiles can be generated independently and stitched.
+    The lattice repeats every 256 noise cells (256 * scale pixels).
     
     Args:
     X, Y: int - dimensions of the heightmap
@@ -29,59 +94,259 @@ def perlin(X, Y, scale=10, octaves=1, persistence=0.5, lacunarity=2.0, seed=None
     persistence: float - amplitude decrease factor for each octave
     lacunarity: float - frequency increase factor for each octave
     seed: int - random seed for reproducibility
+    backend: str - "numpy" or "numba", defaults to the module-level BACKEND
+    x0, y0: int - world coordinates of the top left pixel of the window
+    normalize: str or None - "minmax" rescales this window to [0, 1] using
+        its own min and max, "fixed" maps the theoretical range of the noise
+        to [0, 1] independently of the window, None returns the raw fBm sum
+    dtype: numpy dtype - floating point type, defaults to terra.DTYPE
+    out: numpy array - optional (Y, X) buffer the result is written to
     
     Returns:
     numpy array of the heightmap
     """
-    if seed is not None:
-        np.random.seed(seed)
-    
-    p = generate_permutation(256)
+    backend = BACKEND if backend is None else backend
+    if backend not in ("numpy", "numba"):
+        raise ValueError(f"Unknown noise backend: {backend}")
+    if normalize not in ("minmax", "fixed", None):
+        raise ValueError(f"Unknown normalization: {normalize}")
+    p = generate_permutation(256, seed)
     
-    def noise2d(x, y):
-        X = int(x) & 255
-        Y = int(y) & 255
-        x -= int(x)
-        y -= int(y)
-        u = fade(x)
-        v = fade(y)
-        A = p[X] + Y
-        B = p[X + 1] + Y
-        return lerp(v, 
-                    lerp(u, grad(p[A], x, y), grad(p[B], x - 1, y)),
-                    lerp(u, grad(p[A + 1], x, y - 1), grad(p[B + 1], x - 1, y - 1)))
+    noise = _output_buffer(X, Y, dtype, out)
+    dtype = noise.dtype
+    amplitudes, freqs = octave_weights(scale, octaves, persistence, lacunarity)
+
+    if backend == "numba":
+        from terra.fast_noise import perlin_fbm
+        perlin_fbm(p, X, Y, x0, y0, freqs, amplitudes, GRAD_X, GRAD_Y, noise)
+    else:
+        _accumulate_octaves(noise, noise2d, p, x0, y0, amplitudes, freqs)
     
-    noise = np.zeros((Y, X))
+    return normalize_noise(noise, normalize, amplitudes)
+
+# Number of samples evaluated at once by the NumPy backend. Working on blocks
+# of rows keeps the temporaries of the noise kernels small and cache-resident.
+BLOCK_SIZE = 1 << 16
+
+def _accumulate_octaves(noise, kernel, p, x0, y0, amplitudes, freqs):
+    Y, X = noise.shape
+    x = np.arange(x0, x0 + X)
+    y = np.arange(y0, y0 + Y)
+    rows = max(1, BLOCK_SIZE // X)
+    for amplitude, freq in zip(amplitudes, freqs):
+        xf = x * freq
+        for r in range(0, Y, rows):
+            block = kernel(p, xf, y[r:r + rows] * freq, noise.dtype)
+            block *= float(amplitude)
+            noise[r:r + rows] += block
+    return noise
+
+def _output_buffer(X, Y, dtype, out):
+    if out is None:
+        return np.zeros((Y, X), dtype=get_dtype(dtype))
+    if out.shape != (Y, X):
+        raise ValueError(f"out has shape {out.shape}, expected {(Y, X)}")
+    out.fill(0)
+    return out
+
+def octave_weights(scale, octaves, persistence, lacunarity):
+    """
+    Return the amplitude and frequency of every fBm octave as two arrays.
+    """
+    amplitudes = np.empty(octaves)
+    freqs = np.empty(octaves)
     amplitude = 1.0
     freq = 1.0 / scale
-    for _ in range(octaves):
-        for y in range(Y):
-            for x in range(X):
-                noise[y, x] += amplitude * noise2d(x * freq, y * freq)
+    for o in range(octaves):
+        amplitudes[o] = amplitude
+        freqs[o] = freq
         amplitude *= persistence
         freq *= lacunarity
+    return amplitudes, freqs
+
+def normalize_noise(noise, normalize, amplitudes):
+    """
+    Map an fBm sum to [0, 1] in place, see the normalize argument of perlin.
+    """
+    if normalize == "minmax":
+        lo, hi = noise.min(), noise.max()
+        noise -= lo
+        noise /= hi - lo
+    elif normalize == "fixed":
+        # every octave lies within [-1, 1], so the sum lies within
+        # [-sum(amplitudes), sum(amplitudes)]
+        noise *= 0.5
+        noise /= float(amplitudes.sum())
+        noise += 0.5
+    return noise
+
+# Skewing factors of the 2D simplex grid
+F2 = 0.5 * (math.sqrt(3.0) - 1.0)
+G2 = (3.0 - math.sqrt(3.0)) / 6.0
+
+def simplex2d(p, x, y, dtype=np.float64):
+    """
+    Evaluate 2D simplex noise on a grid.
+
+    Args:
+    p: numpy array - doubled permutation table
+    x: numpy array - sample coordinates along the horizontal axis, shape (X,)
+    y: numpy array - sample coordinates along the vertical axis, shape (Y,)
+    dtype: numpy dtype - floating point type of the result
+
+    Returns:
+    numpy array of shape (Y, X) with values in [-1, 1]
+    """
+    gx, gy = _hashed_gradients(p, dtype)
+    x = x.astype(dtype, copy=False)[np.newaxis, :]
+    y = y.astype(dtype, copy=False)[:, np.newaxis]
+    # Skew the input space to find the simplex cell
+    s = (x + y) * F2
+    i = np.floor(x + s)
+    j = np.floor(y + s)
+    t = (i + j) * G2
+    # Distance from the first corner of the triangle. The other two corners
+    # are at a fixed offset, the middle one depends on which half of the
+    # skewed square the sample lies in.
+    x0 = x - i + t
+    y0 = y - j + t
+    lower = x0 > y0
+    # Corners are hashed like perlin, p[p[j] + i], and the outer lookup is
+    # folded into the gradient tables
+    i = i.astype(np.intp) & 255
+    j = j.astype(np.intp) & 255
+    corner = p[j] + i
+    corner_next = p[j + 1] + i
+    noise = _simplex_corner(gx, gy, corner, x0, y0)
+    noise += _simplex_corner(gx, gy, np.where(lower, corner + 1, corner_next),
+                             x0 - lower + G2, y0 - ~lower + G2)
+    noise += _simplex_corner(gx, gy, corner_next + 1, x0 - 1.0 + 2.0 * G2, y0 - 1.0 + 2.0 * G2)
+    # scale the sum of the radial kernels to [-1, 1], the largest possible
+    # sum with this gradient set is just below 1 / 70
+    noise *= 70.0
+    return noise
+
+def _hashed_gradients(p, dtype=np.float64):
+    # gradient coefficients of every entry of the doubled permutation table,
+    # small enough to stay in cache unlike a table of the whole lattice
+    h = p & 15
+    return GRAD_X[h].astype(dtype), GRAD_Y[h].astype(dtype)
+
+def _simplex_corner(gx, gy, corner, x, y):
+    t = np.maximum(0.5 - x * x - y * y, 0.0)
+    t *= t
+    t *= t
+    return t * (gx[corner] * x + gy[corner] * y)
+
+def simplex(X, Y, scale=10, octaves=1, persistence=0.5, lacunarity=2.0, seed=None, backend=None,
+            x0=0, y0=0, normalize="minmax", dtype=None, out=None):
+    """
+    Generate a simplex noise heightmap.
+
+    Drop-in alternative to perlin: simplex noise blends three corners per
+    sample instead of four and shows fewer axis-aligned artifacts. In 2D
+    that does not make it much cheaper: the NumPy backend is about 10%
+    faster than perlin, the numba backend about 15% slower.
     
-    # Normalize to [0, 1]
-    noise = (noise - noise.min()) / (noise.max() - noise.min())
+    Args:
+    X, Y: int - dimensions of the heightmap
+    scale: float - initial scale of the noise
+    octaves: int - number of octaves for fBm
+    persistence: float - amplitude decrease factor for each octave
+    lacunarity: float - frequency increase factor for each octave
+    seed: int - random seed for reproducibility
+    backend: str - "numpy" or "numba", defaults to the module-level BACKEND
+    x0, y0: int - world coordinates of the top left pixel of the window
+    normalize: str or None - see perlin
+    dtype: numpy dtype - floating point type, defaults to terra.DTYPE
+    out: numpy array - optional (Y, X) buffer the result is written to
     
-    return noise
+    Returns:
+    numpy array of the heightmap
+    """
+    backend = BACKEND if backend is None else backend
+    if backend not in ("numpy", "numba"):
+        raise ValueError(f"Unknown noise backend: {backend}")
+    if normalize not in ("minmax", "fixed", None):
+        raise ValueError(f"Unknown normalization: {normalize}")
+    p = generate_permutation(256, seed)
+    noise = _output_buffer(X, Y, dtype, out)
+    dtype = noise.dtype
+    amplitudes, freqs = octave_weights(scale, octaves, persistence, lacunarity)
+
+    if backend == "numba":
+        from terra.fast_noise import simplex_fbm
+        gx, gy = _hashed_gradients(p)
+        simplex_fbm(p, gx, gy, X, Y, x0, y0, freqs, amplitudes, F2, G2, noise)
+    else:
+        _accumulate_octaves(noise, simplex2d, p, x0, y0, amplitudes, freqs)
+
+    return normalize_noise(noise, normalize, amplitudes)
 
-def billow(X, Y, scale=10, octaves=1, persistence=0.5, lacunarity=2.0, seed=None):
-    return np.absolute(perlin(X=X, Y=Y, scale=scale, octaves=octaves, persistence=persistence, lacunarity=lacunarity, seed=seed))
+def billow(X, Y, scale=10, octaves=1, persistence=0.5, lacunarity=2.0, seed=None, noise=perlin, dtype=None):
+    return np.absolute(noise(X=X, Y=Y, scale=scale, octaves=octaves, persistence=persistence, lacunarity=lacunarity, seed=seed,
+                             dtype=dtype))
 
-def warp(heightmap, shape, warp_strength=2.0, seed=0):
+def warp_field(shape, seed=0, downsample=1, order=3, noise=perlin, dtype=None):
+    """
+    Generate the two-layer Perlin displacement field used by warp.
+
+    Args:
+    shape (tuple): Shape (height, width) of the field
+    seed (int): Random seed, seeds seed..seed+3 are used
+    downsample (int): Compute the noise on a grid this many times coarser
+        and interpolate it up to full size
+    order (int): Spline order used for upsampling
+    noise (callable): Noise generator with the signature of perlin
+    dtype (numpy.dtype): Floating point type, defaults to terra.DTYPE
+
+    Returns:
+    tuple of numpy.ndarray: displacement along x and along y
+    """
+    height, width = shape[0], shape[1]
+    # coarse grid covering the full map
+    h = -(-height // downsample)
+    w = -(-width // downsample)
+    # First warp
+    qx = noise(w, h, scale=20 / downsample, octaves=4, seed=seed, dtype=dtype)
+    qy = noise(w, h, scale=20 / downsample, octaves=4, seed=seed+1, dtype=dtype)
+    # Second warp
+    rx = noise(w, h, scale=10 / downsample, octaves=4, seed=seed+2, dtype=dtype)
+    ry = noise(w, h, scale=10 / downsample, octaves=4, seed=seed+3, dtype=dtype)
+    dx, dy = qx + rx, qy + ry
+    return _resize(dx, shape, order), _resize(dy, shape, order)
+
+def _resize(field, shape, order):
+    if field.shape == tuple(shape[:2]):
+        return field
+    factors = (shape[0] / field.shape[0], shape[1] / field.shape[1])
+    return zoom(field, factors, order=order, mode="nearest", grid_mode=True)
+
+def warp(heightmap, shape, warp_strength=2.0, seed=0, downsample=1, displacement=None, order=3,
+         noise=perlin):
     """
     Warp the input heightmap to create a more organic look.
     Works with heightmaps containing arbitrary values.
 
+    The displacement field is smooth, so on large maps it can be computed on
+    a coarse grid (downsample > 1) or generated once with warp_field and
+    passed in, leaving a single resample of the heightmap as the main cost.
+
     Args:
     heightmap (numpy.ndarray): 2D array representing the heightmap
     shape (tuple): Shape of the heightmap
     warp_strength (float): Strength of the warping effect
     seed (int): Random seed for reproducibility
+    downsample (int): Coarsening factor of the generated displacement field
+    displacement (tuple): Precomputed (dx, dy) field, e.g. from warp_field,
+        of any resolution; it is interpolated up to the heightmap shape
+    order (int): Spline order of the interpolation (0-5)
+    noise (callable): Noise generator with the signature of perlin
     """
     height, width = shape[0], shape[1]
-    y, x = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
+    # work in the floating point type of the input
+    dtype = heightmap.dtype if heightmap.dtype.kind == "f" else get_dtype()
+    y, x = np.meshgrid(np.arange(height, dtype=dtype), np.arange(width, dtype=dtype), indexing='ij')
     # Store original min and max for denormalization later
     original_min = np.min(heightmap)
     original_max = np.max(heightmap)
@@ -93,20 +358,18 @@ def warp(heightmap, shape, warp_strength=2.0, seed=0):
     original_max = np.nanmax(heightmap_filled)
     heightmap_normalized = (heightmap_filled - original_min) / (original_max - original_min)
     # Generate warping noise
-    # First warp
-    qx = perlin(width, height, scale=20, octaves=4, seed=seed)
-    qy = perlin(width, height, scale=20, octaves=4, seed=seed+1)
-    # Second warp
-    rx = perlin(width, height, scale=10, octaves=4, seed=seed+2)
-    ry = perlin(width, height, scale=10, octaves=4, seed=seed+3)
+    if displacement is None:
+        dx, dy = warp_field(shape, seed=seed, downsample=downsample, order=order, noise=noise, dtype=dtype)
+    else:
+        dx, dy = _resize(displacement[0], shape, order), _resize(displacement[1], shape, order)
     # Apply warping
-    x_warped = x + warp_strength * (qx + rx)
-    y_warped = y + warp_strength * (qy + ry)
+    x_warped = x + warp_strength * dx
+    y_warped = y + warp_strength * dy
     # Clip coordinates to ensure they're within the valid range
     x_warped = np.clip(x_warped, 0, width - 1)
     y_warped = np.clip(y_warped, 0, height - 1)
-    # Use cubic interpolation with "reflect" mode to sample the warped heightmap
-    warped_heightmap = map_coordinates(heightmap_normalized, [y_warped, x_warped], order=3, mode="reflect")
+    # Use spline interpolation (cubic by default) with "reflect" mode to sample the warped heightmap
+    warped_heightmap = map_coordinates(heightmap_normalized, [y_warped, x_warped], order=order, mode="reflect")
     # Denormalize the warped heightmap back to the original value range
     warped_heightmap = warped_heightmap * (original_max - original_min) + original_min
     # Reapply the mask after warping
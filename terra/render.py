@@ -4,6 +4,7 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 from matplotlib.colors import LinearSegmentedColormap
 from scipy.spatial import cKDTree
+from terra import get_dtype
 
 def gaussian_blur(height_map, sigma=30):
     """
@@ -15,7 +16,7 @@ def gaussian_blur(height_map, sigma=30):
     """
     return gaussian_filter(height_map, sigma=sigma)
 
-def lingrad(x, y, start, end):
+def lingrad(x, y, start, end, dtype=None):
     """
     Generate a linear gradient height map.
     
@@ -24,12 +25,14 @@ def lingrad(x, y, start, end):
     y (int): Height of the height map.
     start (tuple): (x, y, height) of the start point.
     end (tuple): (x, y, height) of the end point.
+    dtype (np.dtype): Floating point type, defaults to terra.DTYPE.
     
     Returns:
     np.ndarray: A 2D array of shape (y, x) representing the height map.
     """
     # Create a grid of coordinates
-    xv, yv = np.meshgrid(np.arange(x), np.arange(y))
+    dtype = get_dtype(dtype)
+    xv, yv = np.meshgrid(np.arange(x, dtype=dtype), np.arange(y, dtype=dtype))
     # Calculate the difference in coordinates and height
     dx = end[0] - start[0]
     dy = end[1] - start[1]
@@ -110,7 +113,8 @@ def tess_heightmap(tesselation, shape, heightmap):
     # Calculate average height for each cell
     unique_cells = np.unique(cell_indices)
     max_cell_index = np.max(cell_indices)
-    plate_heights = np.zeros(max_cell_index + 1)
+    dtype = heightmap.dtype if heightmap.dtype.kind == "f" else get_dtype()
+    plate_heights = np.zeros(max_cell_index + 1, dtype=dtype)
     for cell in unique_cells:
         mask = cell_map == cell
         plate_heights[cell] = np.mean(heightmap[mask])
@@ -238,12 +242,13 @@ def normal_map(heightmap):
     normal_map = normal_map.astype(np.uint8)
     return normal_map
 
-def shadow_map(normal_map, light_dir=[1, 1, 1]):
+def shadow_map(normal_map, light_dir=[1, 1, 1], dtype=None):
+    dtype = get_dtype(dtype)
     # Normalize the light direction
-    light_dir = np.array(light_dir)
+    light_dir = np.array(light_dir, dtype=dtype)
     light_dir = light_dir / np.linalg.norm(light_dir)
     # Convert normal map back to [-1, 1] range
-    normal_map = normal_map / 255.0 * 2.0 - 1.0
+    normal_map = normal_map.astype(dtype) / 255.0 * 2.0 - 1.0
     # Compute the dot product between the normal map and light direction
     dot_product = np.sum(normal_map * light_dir, axis=2)
     # Clamp the values to [0, 1]
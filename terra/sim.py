@@ -1,37 +1,159 @@
 import numpy as np
+from terra import get_dtype
 from terra.randd import perlin
 
 def pointify(height_map, strength=0.5, get_gradient=False):
-    dy, dx = np.gradient(height_map)
-    gradient_magnitude = np.sqrt(dx**2 + dy**2)
-    gradient_magnitude = gradient_magnitude / np.max(gradient_magnitude)
-    terrain =  height_map * np.exp(-(strength*gradient_magnitude)**2)
+    if height_map.dtype.kind != "f":
+        height_map = height_map.astype(get_dtype())
+    gradient_magnitude = np.empty_like(height_map)
+    terrain = np.empty_like(height_map)
+    _pointify(height_map, strength, gradient_magnitude, terrain)
     if get_gradient: return terrain, gradient_magnitude
     return terrain
 
+def _pointify(height_map, strength, gradient, out):
+    """
+    pointify without temporaries: the normalized gradient magnitude is
+    written to `gradient`, the attenuated heightmap to `out`.
+    """
+    # dy and dx as computed by np.gradient, dx uses `out` as scratch
+    _axis_gradient(height_map, 0, gradient)
+    _axis_gradient(height_map, 1, out)
+    gradient *= gradient
+    out *= out
+    gradient += out
+    np.sqrt(gradient, out=gradient)
+    gradient /= np.max(gradient)
+    # height_map * exp(-(strength * gradient)**2)
+    np.multiply(gradient, strength, out=out)
+    out *= out
+    np.negative(out, out=out)
+    np.exp(out, out=out)
+    out *= height_map
+    return out
+
+def _axis_gradient(f, axis, out):
+    # central differences inside, one-sided differences at the borders
+    f = np.moveaxis(f, axis, 0)
+    out = np.moveaxis(out, axis, 0)
+    np.subtract(f[2:], f[:-2], out=out[1:-1])
+    out[1:-1] /= 2.0
+    np.subtract(f[1], f[0], out=out[0])
+    np.subtract(f[-1], f[-2], out=out[-1])
+    return out
+
 def pointy_perlin(X, Y, scale, octaves=4, persistence=0.35, lacunarity=2.5, 
-                  pointiness=0.5, pointilarity=0.5, seed=42):
-    terrain = np.zeros((Y, X))
+                  pointiness=0.5, pointilarity=0.5, seed=42, noise=perlin, dtype=None):
+    dtype = get_dtype(dtype)
+    terrain = np.zeros((Y, X), dtype=dtype)
+    # per-octave buffers, reused so the loop allocates no full-size arrays
+    layer = np.empty_like(terrain)
+    gradient = np.empty_like(terrain)
+    pointy = np.empty_like(terrain)
     p = 1
     scale = scale
     pointiness = pointiness
     for i in range(octaves):
-        terrain += p*pointify(perlin(X=X, Y=Y, scale=scale, lacunarity=lacunarity, 
-                                     octaves=1, seed=seed+i), strength=pointiness)
+        noise(X=X, Y=Y, scale=scale, lacunarity=lacunarity, 
+              octaves=1, seed=seed+i, dtype=dtype, out=layer)
+        _pointify(layer, pointiness, gradient, pointy)
+        pointy *= p
+        terrain += pointy
         p *= persistence
         scale /= lacunarity
         pointiness += pointilarity
     return terrain
 
-def radial_mask(X, Y, max_value=255):
-    x = np.linspace(-1, 1, X); y = np.linspace(-1, 1, Y)
+def radial_mask(X, Y, max_value=255, dtype=None):
+    dtype = get_dtype(dtype)
+    x = np.linspace(-1, 1, X, dtype=dtype); y = np.linspace(-1, 1, Y, dtype=dtype)
     x_grid, y_grid = np.meshgrid(x, y)
     distance = np.sqrt(x_grid**2 + y_grid**2)
     distance = np.clip(distance, 0, 1)
     heightmap = (1 - distance)**2 * max_value
     return heightmap
 
-def hill(X, Y, seed=42):
-    return radial_mask(X,Y)*pointy_perlin(X=X, Y=Y, octaves=4, scale=np.sqrt(X*Y)*0.85, 
-                                          pointiness=0.7, pointilarity=0.2, seed=seed)
+def hill(X, Y, seed=42, dtype=None):
+    return radial_mask(X,Y, dtype=dtype)*pointy_perlin(X=X, Y=Y, octaves=4, scale=np.sqrt(X*Y)*0.85, 
+                                                       pointiness=0.7, pointilarity=0.2, seed=seed, dtype=dtype)
+
+
+def thermal_erosion(heightmap, iterations=100, talus=None, rate=0.5, tol=None):
+    """
+    Thermal (talus) erosion: material slides between 4-neighbours wherever
+    their height difference exceeds the talus threshold. All cells are
+    updated at once with whole-grid stencil operations on preallocated
+    buffers, so this is a cheap pre-pass before the hydraulic solvers.
+
+    Args:
+    heightmap: numpy array - the heightmap to erode
+    iterations: int - maximum number of iterations
+    talus: float - height difference between neighbours that is stable,
+        defaults to the median difference between neighbouring cells
+    rate: float - fraction (0-1) of the excess moved per iteration
+    tol: float - stop early once no cell pair exchanges more than this
+
+    Returns:
+    numpy array of the eroded heightmap
+    """
+    h = heightmap.astype(heightmap.dtype if heightmap.dtype.kind == "f" else get_dtype())
+    if talus is None:
+        talus = float(np.median(np.abs(np.diff(h, axis=1))))
+    # a cell exchanges with up to four neighbours, a quarter of the excess
+    # per pair keeps the update from overshooting
+    k = 0.25 * rate
+    # material moving right (fx) and down (fy) across each cell boundary,
+    # negative values move the other way
+    fx = np.empty((h.shape[0], h.shape[1] - 1), dtype=h.dtype)
+    fy = np.empty((h.shape[0] - 1, h.shape[1]), dtype=h.dtype)
+    cx = np.empty_like(fx)
+    cy = np.empty_like(fy)
+    for _ in range(iterations):
+        np.subtract(h[:, :-1], h[:, 1:], out=fx)
+        np.subtract(h[:-1], h[1:], out=fy)
+        # excess over the talus threshold: d - clip(d, -talus, talus)
+        np.clip(fx, -talus, talus, out=cx)
+        np.clip(fy, -talus, talus, out=cy)
+        fx -= cx
+        fy -= cy
+        fx *= k
+        fy *= k
+        h[:, :-1] -= fx
+        h[:, 1:] += fx
+        h[:-1] -= fy
+        h[1:] += fy
+        if tol is not None and max(np.abs(fx, out=cx).max(), np.abs(fy, out=cy).max()) < tol:
+            break
+    return h
+
+def wet(heightmap, strength=1, iterations=50):
+    """
+    Soak the terrain: wet soil cannot hold steep slopes, so everything
+    steeper than the typical slope divided by `strength` slumps down.
+
+    Args:
+    heightmap: numpy array - the heightmap to erode
+    strength: float - how wet the soil is, larger values flatten more
+    iterations: int - number of thermal erosion iterations
+
+    Returns:
+    numpy array of the eroded heightmap
+    """
+    talus = float(np.median(np.abs(np.diff(heightmap, axis=1)))) / strength
+    return thermal_erosion(heightmap, iterations=iterations, talus=talus)
+
+def single_drop_erosion(heightmap, iterations=1000, seed=None):
+    """
+    Hydraulic erosion with independent water droplets, see terra.new_erosion.erode.
+
+    Args:
+    heightmap: numpy array - the (square) heightmap to erode
+    iterations: int - number of droplets to simulate
+    seed: int - random seed for reproducibility
 
+    Returns:
+    numpy array of the eroded heightmap
+    """
+    from terra.new_erosion import erode
+    eroded, _ = erode(heightmap, num_iterations=iterations, seed=seed)
+    return eroded
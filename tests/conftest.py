@@ -0,0 +1,5 @@
+import os
+
+# erode_distributed forks its workers, which hangs the interpreter at exit
+# once numba's TBB threading layer has run, see its docstring
+os.environ.setdefault("NUMBA_THREADING_LAYER", "workqueue")
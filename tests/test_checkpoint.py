@@ -0,0 +1,26 @@
+"""
+Runs resumed from a checkpoint continue bit-identically.
+"""
+import numpy as np
+import pytest
+from terra.randd import perlin
+from terra.fast_erosion import erode
+
+@pytest.mark.parametrize("tol, num_iterations, stop", [(None, 40, 25), (0.1, 400, 45)])
+def test_resume(tmp_path, capsys, tol, num_iterations, stop):
+    z = perlin(32, 32, scale=8, seed=1)
+    path = tmp_path / "run.npz"
+    full = erode(z, num_iterations=num_iterations, tol=tol, snapshots="final")
+    full_log = capsys.readouterr().out
+    # stop in the middle of a convergence window (the one the tol run
+    # converges in) and continue
+    erode(z, num_iterations=stop, tol=tol, snapshots="final", checkpoint=path)
+    capsys.readouterr()
+    resumed = erode(z, num_iterations=num_iterations, tol=tol, snapshots="final", checkpoint=path, resume=True)
+    resumed_log = capsys.readouterr().out
+    assert np.array_equal(full[0][-1], resumed[0][-1])
+    assert np.array_equal(full[1][-1], resumed[1][-1])
+    assert np.array_equal(full[2], resumed[2])
+    if tol is not None:
+        assert "Converged after 50 iterations" in full_log
+        assert "Converged after 50 iterations" in resumed_log
@@ -0,0 +1,16 @@
+"""
+Distributed runs match the NumPy backend whatever the number of workers.
+"""
+import numpy as np
+import pytest
+from terra.randd import perlin
+from terra.fast_erosion import erode, erode_distributed
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_matches_numpy_backend(workers):
+    z = perlin(48, 40, scale=12, seed=2)
+    saved_z, saved_h, s, _ = erode(z, num_iterations=20, backend="numpy", snapshots="final")
+    z_w, h_w, s_w = erode_distributed(z, num_iterations=20, workers=workers)
+    assert np.array_equal(saved_z[-1], z_w)
+    assert np.array_equal(saved_h[-1], h_w)
+    assert np.array_equal(s, s_w)
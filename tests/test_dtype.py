@@ -0,0 +1,40 @@
+"""
+Numerical drift of float32 runs compared with float64.
+"""
+import numpy as np
+import pytest
+import terra
+from terra.randd import perlin, simplex
+from terra.sim import pointy_perlin
+from terra.fast_erosion import erode
+
+@pytest.mark.parametrize("noise", [perlin, simplex])
+@pytest.mark.parametrize("backend", ["numpy", "numba"])
+def test_noise_drift(noise, backend):
+    kwargs = dict(scale=32, octaves=4, seed=3, backend=backend)
+    a = noise(128, 96, dtype=np.float32, **kwargs)
+    b = noise(128, 96, dtype=np.float64, **kwargs)
+    assert a.dtype == np.float32 and b.dtype == np.float64
+    assert np.abs(a - b).max() < 4e-6
+
+def test_pointy_perlin_drift():
+    a = pointy_perlin(128, 96, scale=48, dtype=np.float32)
+    b = pointy_perlin(128, 96, scale=48, dtype=np.float64)
+    assert a.dtype == np.float32
+    assert np.abs(a - b).max() < 4e-6
+
+def test_erosion_drift():
+    z = perlin(48, 48, scale=16, seed=1, dtype=np.float64)
+    a = erode(z, num_iterations=100, dtype=np.float32)[0][-1]
+    b = erode(z, num_iterations=100, dtype=np.float64)[0][-1]
+    assert a.dtype == np.float32
+    assert np.abs(a - b).max() < 3e-4
+
+def test_default_dtype():
+    try:
+        terra.set_dtype(np.float32)
+        assert perlin(16, 16, seed=0).dtype == np.float32
+    finally:
+        terra.set_dtype(np.float64)
+    with pytest.raises(ValueError):
+        terra.set_dtype(np.int32)